@@ -0,0 +1,51 @@
+from collections import namedtuple
+from functools import wraps
+
+from flask import request
+
+from app.api_v1.errors import bad_request, server_error, unauthorized, invalid_token
+from app.models import User
+from app.utils import authorize, parse_authorization_header, verify_access_token
+
+# User passed to views, it's built from access token without loading user from db
+AuthorizedUser = namedtuple('AuthorizedUser', ['id', 'login'])
+
+
+def auth_required(view):
+    """ Check 'Authorization' header and pass authorized user to view.
+
+    Header may contain HTTP Basic credentials or access token issued by /users/authorize as
+    'Bearer <token>'.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        headers = request.headers or {}
+
+        # Check request
+        if 'Authorization' not in headers:
+            return bad_request("Missing 'Authorization' header in request")
+
+        if headers.get('Authorization').startswith('Bearer '):
+            data = verify_access_token(headers.get('Authorization').split(' ', 1)[1])
+            if not data:
+                return invalid_token()
+
+            return view(AuthorizedUser(data['id'], data['login']), *args, **kwargs)
+
+        # Parse auth
+        try:
+            login, password = parse_authorization_header(headers.get('Authorization'))
+        except Exception as e:
+            return server_error(f"Exception occurred during parsing user credentials: {str(e)}")
+
+        try:
+            user = User.query.filter_by(login=login).first()
+        except Exception as e:
+            return server_error(f"Exception occurred during loading user: {str(e)}")
+
+        if user and authorize(login, password, user):
+            return view(AuthorizedUser(user.id, user.login), *args, **kwargs)
+        else:
+            return unauthorized(login)
+
+    return wrapper
@@ -20,4 +20,8 @@ def server_error(message):
 
 
 def unauthorized(login):
-    return error_response(403, f"Authentication failed for user {login}")
\ No newline at end of file
+    return error_response(403, f"Authentication failed for user {login}")
+
+
+def invalid_token():
+    return error_response(403, "Access token is invalid or expired")
@@ -0,0 +1,39 @@
+from functools import wraps
+
+from flask import request, Response
+
+from app.versions import user_versions
+
+
+def user_etag(view):
+    """ Tag response with version of user data and answer 304 if client already has it.
+
+    Version is checked before view is called, so unchanged data is neither loaded nor serialized.
+    Must be applied after auth_required.
+    """
+    return _tagged(view, user_versions.etag)
+
+
+def alarm_etag(view):
+    """ Same as user_etag for views which return only alarms, new readings don't change their tag
+    """
+    return _tagged(view, user_versions.alarm_etag)
+
+
+def _tagged(view, get_etag):
+    @wraps(view)
+    def wrapper(user, *args, **kwargs):
+        etag = get_etag(user.id)
+
+        if etag in request.if_none_match:
+            resp = Response(status=304)
+        else:
+            resp = view(user, *args, **kwargs)
+            if resp.status_code != 200:
+                return resp
+
+        resp.set_etag(etag)
+        resp.headers['Cache-Control'] = 'private, no-cache'
+        return resp
+
+    return wrapper
@@ -1,358 +1,364 @@
 import datetime
 
-from flask import request
+from flask import request, Response, stream_with_context
 
-from app import db
+from app import app, db
 from app.api_v1 import bp
-from app.models import FlowerType, User, Flower, Sensor, RecommendationItem, RecommendationAlarm
-from app.utils import create_response_from_data_with_code, parse_authorization_header, authorize, \
-    recommendation_classes
-from app.api_v1.errors import server_error, bad_request, error_response, unauthorized
+from app.bridge import MESSAGE_FLOWERS, bridge
+from app.catalog import get_catalog
+from app.cluster import owns_flower, listen_for_events
+from app.events import EVENT_ALARM_RAISED, EVENT_ALARM_CLEARED, EVENT_READING, event_bus, \
+    format_event
+from app.models import Flower, Sensor, RecommendationItem, RecommendationAlarm, SensorLatest
+from app.utils import create_response_from_data_with_code, recommendation_classes
+from app.api_v1.auth import auth_required
+from app.api_v1.etag import user_etag, alarm_etag
+from app.api_v1.errors import server_error, bad_request, error_response
+from app.export import EXPORT_FORMATS, metric_rows, export_ndjson, export_csv
+from app.ingest import parse_reading_time
 from app.recommendations.engine import RecommendationBackGroundTask
+from app.recommendations.summary import get_alarm_summary
+from app.versions import user_versions
+from app.rollups import metric_history
 import logging
 
 FLOWERS_API_PREFIX = '/flowers'
 
+# Response keys of active alarms by severity
+ALARM_KEYS = {2: 'recommendations', 1: 'warnings', 0: 'problems'}
+
 
 @bp.route(f'{FLOWERS_API_PREFIX}/types', methods=['GET'])
 def get_flower_types():
     """ Return list of possible flower types """
     # logging.info("Getting list of flowers ...")
     try:
-        flowers = FlowerType.query.all() or {}
+        catalog = get_catalog()
     except Exception as e:
         return server_error(f"Exception occurred while getting flower types list: {str(e)}")
-    resp = create_response_from_data_with_code(
-        list(map(lambda x: x.to_dict(), flowers)), 200)
+
+    if catalog.flower_types_etag in request.if_none_match:
+        resp = Response(status=304)
+    else:
+        resp = Response(catalog.flower_types_payload, status=200, mimetype='application/json')
+    resp.set_etag(catalog.flower_types_etag)
 
     return resp
 
 
 @bp.route(FLOWERS_API_PREFIX, methods=['POST'])
-def create_flower():
+@auth_required
+def create_flower(user):
     """ Create flower if it doesn't exists """
     logging.info("Called creating flower endpoint ...")
 
-    headers = request.headers or {}
+    data = request.get_json() or {}
+    logging.info(data)
+    if 'name' not in data or 'type' not in data or 'sensor' not in data:
+        return bad_request(f"Request must includes name, sensor and type fields. Request: "
+                           f"{data}")
 
-    # Check request
-    if 'Authorization' not in headers:
-        return bad_request("Missing 'Authorization' header in request")
+    if Flower.query.filter_by(name=data.get('name')).first():
+        return error_response(500, f"Flower with name {data.get('name')} already exists for "
+                                   f"user {user.login}")
 
-    # Parse auth
-    try:
-        login, password = parse_authorization_header(headers.get('Authorization'))
-    except Exception as e:
-        return server_error(f"Exception occurred during parsing user credentials: {str(e)}")
+    sensor = Sensor.query.filter_by(serial_number=data.get('sensor')).first()
 
-    try:
-        user = User.query.filter_by(login=login).first()
-    except Exception as e:
-        return server_error(f"Exception occurred during loading user: {str(e)}")
-
-    if user and authorize(login, password, user):
-        data = request.get_json() or {}
-        logging.info(data)
-        if 'name' not in data or 'type' not in data or 'sensor' not in data:
-            return bad_request(f"Request must includes name, sensor and type fields. Request: "
-                               f"{data}")
-
-        if Flower.query.filter_by(name=data.get('name')).first():
-            return error_response(500, f"Flower with name {data.get('name')} already exists for "
-                                       f"user {login}")
-
-        sensor = Sensor.query.filter_by(serial_number=data.get('sensor')).first()
-
-        if not sensor or sensor.token != user.token:
-            bad_request("Incorrect sensor serial number")
-
-        flower = Flower()
-        flower.name = data.get('name')
-        flower.flower_type = data.get('type')
-        flower.user = user.id
-        flower.sensor = sensor.id
-        flower.last_transplantation_year = data.get('last_transplantation_year') or \
-                                           datetime.datetime.now().year
-
-        # Commit changes to db
-        db.session.add(flower)
-        db.session.commit()
+    if not sensor or sensor.user != user.id:
+        return bad_request("Incorrect sensor serial number")
+
+    flower = Flower()
+    flower.name = data.get('name')
+    flower.flower_type = data.get('type')
+    flower.user = user.id
+    flower.sensor = sensor.id
+    flower.last_transplantation_year = data.get('last_transplantation_year') or \
+                                       datetime.datetime.now().year
 
-        for recommendation_class in recommendation_classes():
-            recom = RecommendationItem()
-            recom.r_class=recommendation_class.__name__
-            recom.flower = flower.id
+    # Commit changes to db
+    db.session.add(flower)
+    db.session.commit()
 
-            db.session.add(recom)
-            db.session.commit()
+    for recommendation_class in recommendation_classes():
+        recom = RecommendationItem()
+        recom.r_class=recommendation_class.__name__
+        recom.flower = flower.id
 
+        db.session.add(recom)
+        db.session.commit()
+
+        # Tasks are run by process which owns shard of flower, it's notified if it's another one
+        if owns_flower(flower.id):
             RecommendationBackGroundTask(recommendation_class.create_from_db(t_id=recom.id,
                                                                              flower=flower))
 
-        resp_data = flower.to_dict()
-        resp_data['recommendations'] = _get_alarms_for_flower(user, id, 2)
-        resp_data['warnings'] = _get_alarms_for_flower(user, id, 1)
-        resp_data['problems'] = _get_alarms_for_flower(user, id, 0)
-        return create_response_from_data_with_code(resp_data, 201)
-    else:
-        return unauthorized(login)
+    bridge.publish(MESSAGE_FLOWERS, [flower.id])
+    user_versions.bump([user.id])
+    db.session.commit()
+
+    return create_response_from_data_with_code(_get_flowers_data(user, flower.id)[0], 201)
 
 
 @bp.route(FLOWERS_API_PREFIX, methods=['GET'])
-def get_user_flowers():
+@auth_required
+@user_etag
+def get_user_flowers(user):
     """ Return list of user flowers """
     logging.info("Called getting flowers endpoint ...")
 
-    headers = request.headers or {}
+    return create_response_from_data_with_code(_get_flowers_data(user), 200)
 
-    # Check request
-    if 'Authorization' not in headers:
-        return bad_request("Missing 'Authorization' header in request")
 
-    # Parse auth
-    try:
-        login, password = parse_authorization_header(headers.get('Authorization'))
-    except Exception as e:
-        return server_error(f"Exception occurred during parsing user credentials: {str(e)}")
+@bp.route('/flowers/<int:id>', methods=['GET'])
+@auth_required
+@user_etag
+def get_flower_by_id(user, id):
+    """ Return list of user flowers """
+    logging.info("Called getting flowers endpoint ...")
 
-    try:
-        user = User.query.filter_by(login=login).first()
-    except Exception as e:
-        return server_error(f"Exception occurred during loading user: {str(e)}")
+    data = _get_flowers_data(user, id)
+    if not data:
+        return error_response(404, f"Flower {id} not found")
 
-    if user and authorize(login, password, user):
-        u_flowers = user.flowers.all()
-        data = list()
+    return create_response_from_data_with_code(data[0], 200)
 
-        for fl in u_flowers:
-            fl_data = fl.to_dict()
-            fl_data['recommendations'] = _get_alarms_for_flower(user, fl.id, 2)
-            fl_data['warnings'] = _get_alarms_for_flower(user, fl.id, 1)
-            fl_data['problems'] = _get_alarms_for_flower(user, fl.id, 0)
-            data.append(fl_data)
 
-        return create_response_from_data_with_code(data, 200)
-    else:
-        return unauthorized(login)
+@bp.route('/flowers/<int:id>/metrics', methods=['GET'])
+@auth_required
+def get_flower_metrics(user, id):
+    """ Return metrics history of flower.
 
+    Query parameters 'from' and 'to' are unix times or ISO 8601 strings, 'resolution' is length of
+    bucket in seconds. Resolution is increased if period includes too many buckets.
+    """
+    logging.info("Called getting flower metrics endpoint ...")
 
-@bp.route('/flowers/<int:id>', methods=['GET'])
-def get_flower_by_id(id):
-    """ Return list of user flowers """
-    logging.info("Called getting flowers endpoint ...")
+    flower = Flower.query.filter_by(id=id, user=user.id).first()
+    if not flower:
+        return error_response(404, f"Flower {id} not found")
 
-    headers = request.headers or {}
-
-    # Check request
-    if 'Authorization' not in headers:
-        return bad_request("Missing 'Authorization' header in request")
-
-    # Parse auth
     try:
-        login, password = parse_authorization_header(headers.get('Authorization'))
-    except Exception as e:
-        return server_error(f"Exception occurred during parsing user credentials: {str(e)}")
+        end = _parse_time_arg(request.args.get('to')) or datetime.datetime.now()
+        start = _parse_time_arg(request.args.get('from')) or \
+            end - datetime.timedelta(seconds=app.config.get('HISTORY_DEFAULT_PERIOD', 86400))
+        resolution = int(request.args.get('resolution', 1))
+    except (ValueError, OverflowError, OSError) as e:
+        return bad_request(f"Incorrect metrics query: {str(e)}")
 
-    try:
-        user = User.query.filter_by(login=login).first()
-    except Exception as e:
-        return server_error(f"Exception occurred during loading user: {str(e)}")
-
-    if user and authorize(login, password, user):
-        flower = user.flowers.filter_by(id=id).first()
-        resp_data = flower.to_dict() or {}
-        resp_data['recommendations'] = _get_alarms_for_flower(user, id, 2)
-        resp_data['warnings'] = _get_alarms_for_flower(user, id, 1)
-        resp_data['problems'] = _get_alarms_for_flower(user, id, 0)
-        return create_response_from_data_with_code(resp_data, 200)
-    else:
-        return unauthorized(login)
+    if start >= end or resolution <= 0:
+        return bad_request("Period must be not empty and resolution must be positive")
 
+    max_points = app.config.get('HISTORY_MAX_POINTS', 500)
+    resolution = max(resolution, -(-int((end - start).total_seconds()) // max_points))
 
-def _get_alarms_for_flowers(user, severity=2):
-    alarms = list()
-    u_flowers = user.flowers.filter_by(user=user.id).all()
-    for fl in u_flowers:
-        fl_tasks = RecommendationItem.query.filter_by(flower=fl.id).all()
-        for t in fl_tasks:
-            t_alarms = RecommendationAlarm.query.filter_by(task=t.id, severity=severity).all()
-            alarms.extend([x.message for x in t_alarms])
+    source, metrics = (None, []) if flower.sensor is None else \
+        metric_history(flower.sensor, start, end, resolution)
 
-    return alarms
+    return create_response_from_data_with_code({'flower': flower.id, 'from': start, 'to': end,
+                                                'resolution': resolution, 'source': source,
+                                                'metrics': metrics}, 200)
 
 
-def _get_alarms_for_flower(user, fl_id, severity=2):
-    alarms = list()
-    flower = user.flowers.filter_by(user=user.id, id=fl_id).first()
-    fl_tasks = RecommendationItem.query.filter_by(flower=flower.id).all()
-    for t in fl_tasks:
-        t_alarms = RecommendationAlarm.query.filter_by(task=t.id, severity=severity).all()
-        alarms.extend([x.message for x in t_alarms])
+@bp.route('/flowers/<int:id>/metrics/export', methods=['GET'])
+@auth_required
+def export_flower_metrics(user, id):
+    """ Stream raw metrics of flower as NDJSON or CSV.
 
-    return alarms
+    Query parameters 'from' and 'to' limit period, whole history is exported by default.
+    """
+    logging.info("Called exporting flower metrics endpoint ...")
 
+    flower = Flower.query.filter_by(id=id, user=user.id).first()
+    if not flower:
+        return error_response(404, f"Flower {id} not found")
 
-@bp.route('/flowers/recommendations', methods=['GET'])
-def get_user_flowers_active_recommendations():
-    logging.info("Called getting flowers recommendations endpoint ...")
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return bad_request(f"Format must be one of: {', '.join(EXPORT_FORMATS)}")
 
-    headers = request.headers or {}
+    try:
+        start = _parse_time_arg(request.args.get('from'))
+        end = _parse_time_arg(request.args.get('to'))
+    except (ValueError, OverflowError, OSError) as e:
+        return bad_request(f"Incorrect export query: {str(e)}")
 
-    # Check request
-    if 'Authorization' not in headers:
-        return bad_request("Missing 'Authorization' header in request")
+    # Serial number is resolved once for all rows
+    sensor = Sensor.query.get(flower.sensor) if flower.sensor else None
+    rows = metric_rows(sensor.id, start, end) if sensor else iter(())
+    serial_number = sensor.serial_number if sensor else None
 
-    # Parse auth
-    try:
-        login, password = parse_authorization_header(headers.get('Authorization'))
-    except Exception as e:
-        return server_error(f"Exception occurred during parsing user credentials: {str(e)}")
+    export = export_ndjson if export_format == 'ndjson' else export_csv
+    mimetype, extension = EXPORT_FORMATS[export_format]
 
-    try:
-        user = User.query.filter_by(login=login).first()
-    except Exception as e:
-        return server_error(f"Exception occurred during loading user: {str(e)}")
+    resp = Response(stream_with_context(export(rows, serial_number)), mimetype=mimetype)
+    resp.headers['Content-Disposition'] = \
+        f'attachment; filename=flower-{flower.id}-metrics.{extension}'
 
-    if user and authorize(login, password, user):
-        return create_response_from_data_with_code(_get_alarms_for_flowers(user, 2), 200)
-    else:
-        return unauthorized(login)
+    return resp
 
 
-@bp.route('/flowers/problems', methods=['GET'])
-def get_user_flowers_active_problems():
-    logging.info("Called getting flowers problems endpoint ...")
+@bp.route('/flowers/events', methods=['GET'])
+@auth_required
+def get_user_flowers_events(user):
+    """ Stream changes of alarms of user flowers as Server-Sent Events.
+
+    New metrics of user sensors are streamed too if query parameter 'readings' is set. Client
+    which reads events too slowly gets 'dropped' event and should reconnect.
+    """
+    logging.info("Called flowers events endpoint ...")
+
+    event_types = [EVENT_ALARM_RAISED, EVENT_ALARM_CLEARED]
+    if request.args.get('readings', '').lower() in ('1', 'true', 'yes'):
+        event_types.append(EVENT_READING)
+
+    heartbeat = app.config.get('EVENTS_HEARTBEAT_INTERVAL', 15)
+    subscription = event_bus.subscribe(user.id, event_types,
+                                       app.config.get('EVENTS_MAX_QUEUE', 100),
+                                       app.config.get('EVENTS_MAX_STREAMS', 4))
+    # Every stream holds a thread of the server, the rest of them must serve other requests
+    if subscription is None:
+        resp = error_response(503, "Too many event streams are open, try again later")
+        resp.headers['Retry-After'] = str(int(heartbeat))
+        return resp
+
+    listen_for_events()
+
+    # Stream doesn't use db, so request context and session aren't kept while it's open
+    def events():
+        try:
+            yield f'retry: {int(heartbeat * 1000)}\n\n'
+            while True:
+                event = subscription.get(heartbeat)
+                if event:
+                    yield format_event(*event)
+                elif subscription.dropped:
+                    yield format_event('dropped', {'reason': "Events were read too slowly"})
+                    return
+                else:
+                    yield ': heartbeat\n\n'
+        finally:
+            event_bus.unsubscribe(subscription)
+
+    resp = Response(events(), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
 
-    headers = request.headers or {}
+    return resp
 
-    # Check request
-    if 'Authorization' not in headers:
-        return bad_request("Missing 'Authorization' header in request")
 
-    # Parse auth
-    try:
-        login, password = parse_authorization_header(headers.get('Authorization'))
-    except Exception as e:
-        return server_error(f"Exception occurred during parsing user credentials: {str(e)}")
+def _parse_time_arg(value):
+    if not value:
+        return None
 
     try:
-        user = User.query.filter_by(login=login).first()
-    except Exception as e:
-        return server_error(f"Exception occurred during loading user: {str(e)}")
+        value = float(value)
+    except ValueError:
+        pass
 
-    if user and authorize(login, password, user):
-        return create_response_from_data_with_code(_get_alarms_for_flowers(user, 0), 200)
-    else:
-        return unauthorized(login)
+    return parse_reading_time(value)
 
 
-@bp.route('/flowers/warnings', methods=['GET'])
-def get_user_flowers_active_warnings():
-    logging.info("Called getting flowers warnings endpoint ...")
+def _get_flowers_data(user, fl_id=None):
+    """ Return flowers of user with last sensor data and active alarms.
 
-    headers = request.headers or {}
-    alarms = list()
+    Flowers, their sensors and last metrics are loaded with one query and alarms of all flowers
+    with another one, so number of queries doesn't depend on number of flowers.
+    """
+    flowers = db.session.query(Flower, Sensor.serial_number, SensorLatest) \
+        .outerjoin(Sensor, Sensor.id == Flower.sensor) \
+        .outerjoin(SensorLatest, SensorLatest.sensor == Flower.sensor) \
+        .filter(Flower.user == user.id)
 
-    # Check request
-    if 'Authorization' not in headers:
-        return bad_request("Missing 'Authorization' header in request")
+    alarms = db.session.query(RecommendationItem.flower, RecommendationAlarm.severity,
+                              RecommendationAlarm.message) \
+        .join(RecommendationAlarm, RecommendationAlarm.task == RecommendationItem.id) \
+        .join(Flower, Flower.id == RecommendationItem.flower) \
+        .filter(Flower.user == user.id)
 
-    # Parse auth
-    try:
-        login, password = parse_authorization_header(headers.get('Authorization'))
-    except Exception as e:
-        return server_error(f"Exception occurred during parsing user credentials: {str(e)}")
+    if fl_id is not None:
+        flowers = flowers.filter(Flower.id == fl_id)
+        alarms = alarms.filter(Flower.id == fl_id)
 
-    try:
-        user = User.query.filter_by(login=login).first()
-    except Exception as e:
-        return server_error(f"Exception occurred during loading user: {str(e)}")
+    # Group alarm messages by flower and severity
+    fl_alarms = dict()
+    for flower_id, severity, message in alarms.order_by(RecommendationItem.id,
+                                                         RecommendationAlarm.id):
+        fl_alarms.setdefault((flower_id, severity), list()).append(message)
 
-    if user and authorize(login, password, user):
-        return create_response_from_data_with_code(_get_alarms_for_flowers(user, 1), 200)
-    else:
-        return unauthorized(login)
+    data = list()
+    for fl, serial_number, latest in flowers.order_by(Flower.id):
+        fl_data = fl.to_dict(latest.to_dict(serial_number) if latest else {})
+        for severity, key in ALARM_KEYS.items():
+            fl_data[key] = fl_alarms.get((fl.id, severity), [])
+        data.append(fl_data)
 
+    return data
 
-@bp.route('/flowers/<int:id>/problems', methods=['GET'])
-def get_flower_active_problems(id):
-    logging.info("Called getting flower problems endpoint ...")
 
-    headers = request.headers or {}
-    alarms = list()
+def _get_alarms_for_flowers(user, severity=2):
+    return list(get_alarm_summary(user.id).get(severity, ()))
 
-    # Check request
-    if 'Authorization' not in headers:
-        return bad_request("Missing 'Authorization' header in request")
 
-    # Parse auth
-    try:
-        login, password = parse_authorization_header(headers.get('Authorization'))
-    except Exception as e:
-        return server_error(f"Exception occurred during parsing user credentials: {str(e)}")
+def _get_alarms_for_flower(user, fl_id, severity=2):
+    alarms = db.session.query(RecommendationAlarm.message) \
+        .join(RecommendationItem, RecommendationAlarm.task == RecommendationItem.id) \
+        .join(Flower, Flower.id == RecommendationItem.flower) \
+        .filter(Flower.user == user.id, Flower.id == fl_id,
+                RecommendationAlarm.severity == severity) \
+        .order_by(RecommendationItem.id, RecommendationAlarm.id)
 
-    try:
-        user = User.query.filter_by(login=login).first()
-    except Exception as e:
-        return server_error(f"Exception occurred during loading user: {str(e)}")
+    return [x.message for x in alarms]
 
-    if user and authorize(login, password, user):
-        return create_response_from_data_with_code(_get_alarms_for_flower(user, id, 0), 200)
-    else:
-        return unauthorized(login)
 
+@bp.route('/flowers/recommendations', methods=['GET'])
+@auth_required
+@alarm_etag
+def get_user_flowers_active_recommendations(user):
+    logging.info("Called getting flowers recommendations endpoint ...")
 
-@bp.route('/flowers/<int:id>/warning', methods=['GET'])
-def get_flower_active_warning(id):
-    logging.info("Called getting flower warning endpoint ...")
+    return create_response_from_data_with_code(_get_alarms_for_flowers(user, 2), 200)
+
+
+@bp.route('/flowers/problems', methods=['GET'])
+@auth_required
+@alarm_etag
+def get_user_flowers_active_problems(user):
+    logging.info("Called getting flowers problems endpoint ...")
 
-    headers = request.headers or {}
-    alarms = list()
+    return create_response_from_data_with_code(_get_alarms_for_flowers(user, 0), 200)
 
-    # Check request
-    if 'Authorization' not in headers:
-        return bad_request("Missing 'Authorization' header in request")
 
-    # Parse auth
-    try:
-        login, password = parse_authorization_header(headers.get('Authorization'))
-    except Exception as e:
-        return server_error(f"Exception occurred during parsing user credentials: {str(e)}")
+@bp.route('/flowers/warnings', methods=['GET'])
+@auth_required
+@alarm_etag
+def get_user_flowers_active_warnings(user):
+    logging.info("Called getting flowers warnings endpoint ...")
 
-    try:
-        user = User.query.filter_by(login=login).first()
-    except Exception as e:
-        return server_error(f"Exception occurred during loading user: {str(e)}")
+    return create_response_from_data_with_code(_get_alarms_for_flowers(user, 1), 200)
 
-    if user and authorize(login, password, user):
-        return create_response_from_data_with_code(_get_alarms_for_flower(user, id, 1), 200)
-    else:
-        return unauthorized(login)
 
+@bp.route('/flowers/<int:id>/problems', methods=['GET'])
+@auth_required
+@alarm_etag
+def get_flower_active_problems(user, id):
+    logging.info("Called getting flower problems endpoint ...")
 
-@bp.route('/flowers/<int:id>/recommendations', methods=['GET'])
-def get_flower_active_recommendations(id):
-    logging.info("Called getting flower recommendations endpoint ...")
+    return create_response_from_data_with_code(_get_alarms_for_flower(user, id, 0), 200)
 
-    headers = request.headers or {}
-    alarms = list()
 
-    # Check request
-    if 'Authorization' not in headers:
-        return bad_request("Missing 'Authorization' header in request")
+@bp.route('/flowers/<int:id>/warning', methods=['GET'])
+@auth_required
+@alarm_etag
+def get_flower_active_warning(user, id):
+    logging.info("Called getting flower warning endpoint ...")
 
-    # Parse auth
-    try:
-        login, password = parse_authorization_header(headers.get('Authorization'))
-    except Exception as e:
-        return server_error(f"Exception occurred during parsing user credentials: {str(e)}")
+    return create_response_from_data_with_code(_get_alarms_for_flower(user, id, 1), 200)
 
-    try:
-        user = User.query.filter_by(login=login).first()
-    except Exception as e:
-        return server_error(f"Exception occurred during loading user: {str(e)}")
 
-    if user and authorize(login, password, user):
-        return create_response_from_data_with_code(_get_alarms_for_flower(user, id, 2), 200)
-    else:
-        return unauthorized(login)
+@bp.route('/flowers/<int:id>/recommendations', methods=['GET'])
+@auth_required
+@alarm_etag
+def get_flower_active_recommendations(user, id):
+    logging.info("Called getting flower recommendations endpoint ...")
+
+    return create_response_from_data_with_code(_get_alarms_for_flower(user, id, 2), 200)
@@ -1,13 +1,20 @@
-import datetime
 import logging
 
 from flask import request
 
-from app import db
+from app import app, cluster
 from app.api_v1 import bp
-from app.models import User, Sensor, FlowerMetric
-from app.api_v1.errors import bad_request, unauthorized, server_error
-from app.utils import create_response_from_data_with_code, authorize, parse_authorization_header
+from app.models import Sensor
+from app.api_v1.auth import auth_required
+from app.api_v1.errors import bad_request
+from app.bridge import bridge
+from app.events import event_bus
+from app.ingest import metric_from_data, store_metrics, get_ingest_buffer, get_user_id, \
+    get_sensor_ids, parse_serial, user_cache, sensor_cache
+from app.listener import hub_listener
+from app.recommendations.alarms import alarm_store
+from app.recommendations.summary import summary_cache
+from app.utils import create_response_from_data_with_code
 
 SENSORS_API_PREFIX = '/sensors'
 
@@ -17,70 +24,103 @@ def ping():
     return "OK"
 
 
+@bp.route(f'/hub/stats')
+@auth_required
+def ingest_stats(user):
+    """ Return ingest, alarm and cluster counters of this process, they are shown to signed in
+    users only """
+    stats = {'user_cache': user_cache.stats(), 'sensor_cache': sensor_cache.stats(),
+             'alarms': alarm_store.stats(), 'alarm_summary_cache': summary_cache.stats(),
+             'events': event_bus.stats(), 'listener': hub_listener.stats()}
+    if cluster.engine_shards:
+        stats['engine'] = cluster.engine_shards.stats()
+    if bridge.enabled:
+        stats['bridge'] = bridge.stats()
+    if app.config.get('INGEST_WRITE_BEHIND'):
+        stats['buffer'] = get_ingest_buffer().stats()
+
+    return create_response_from_data_with_code(stats, 200)
+
+
 @bp.route(f'/hub/<string:token>/sensor', methods=["POST"])
 def accept_data(token):
     """ Register sensor if it's new sensor and send data to metrics storage """
     # Check token
-    user = User.query.filter_by(token=token).first()
+    user_id = get_user_id(token)
 
-    if not user:
+    if not user_id:
         return bad_request("Unregistered token")
 
     data = request.get_json() or {}
 
-    if 'serial' not in data:
+    if not isinstance(data, dict) or 'serial' not in data:
         return bad_request("Request must includes 'serial' field")
 
-    # Register sensor if not registered
-    sensor = Sensor.query.filter_by(token=token, serial_number=data.get('serial')).first()
-
-    if not sensor:
-        sensor = Sensor()
-        sensor.serial_number = data.get('serial')
-        sensor.token = token
-        sensor.user = user.id
-
-        # Commit changes to db
-        db.session.add(sensor)
-        db.session.commit()
+    try:
+        serial = parse_serial(data.get('serial'))
+    except ValueError as e:
+        return bad_request(f"Incorrect serial: {str(e)}")
 
-    metric = FlowerMetric()
-    metric.time = datetime.datetime.now()
-    metric.sensor = sensor.id
     logging.info(f"Received metric: {data}")
-    metric.temperature =float(data.get('temperature', -1.0))
-    metric.light = 500.0 - float(data.get('light', -1.0))
-    metric.soilMoisture = 100.0 - float(data.get('soilMoisture', -1.0)) / 10.0
+    try:
+        metric = metric_from_data(None, data)
+    except (TypeError, ValueError, OverflowError, OSError) as e:
+        return bad_request(f"Incorrect metric data: {str(e)}")
+
+    # Register sensor if not registered, data is checked before
+    metric['sensor'] = get_sensor_ids(token, user_id, [serial])[serial]
 
     # Commit changes to db
-    db.session.add(metric)
-    db.session.commit()
+    store_metrics([metric])
 
     return create_response_from_data_with_code({}, 204)
 
 
-@bp.route(SENSORS_API_PREFIX, methods=['GET'])
-def get_available_sensors():
-    headers = request.headers or {}
+@bp.route(f'/hub/<string:token>/sensors/batch', methods=["POST"])
+def accept_data_batch(token):
+    """ Store list of readings of several sensors, registering new sensors """
+    # Check token
+    user_id = get_user_id(token)
 
-    # Check request
-    if 'Authorization' not in headers:
-        return bad_request("Missing 'Authorization' header in request")
+    if not user_id:
+        return bad_request("Unregistered token")
+
+    data = request.get_json()
+    readings = data.get('readings') if isinstance(data, dict) else data
+
+    if not isinstance(readings, list):
+        return bad_request("Request must be a list of readings or includes 'readings' list")
+
+    if len(readings) > app.config['INGEST_BATCH_MAX_READINGS']:
+        return bad_request(f"Request includes more than "
+                           f"{app.config['INGEST_BATCH_MAX_READINGS']} readings")
+
+    if not all(isinstance(x, dict) and 'serial' in x for x in readings):
+        return bad_request("Every reading must includes 'serial' field")
 
-    # Parse auth
     try:
-        login, password = parse_authorization_header(headers.get('Authorization'))
-    except Exception as e:
-        return server_error(f"Exception occurred during parsing user credentials: {str(e)}")
+        serials = [parse_serial(x.get('serial')) for x in readings]
+    except ValueError as e:
+        return bad_request(f"Incorrect serial: {str(e)}")
 
     try:
-        user = User.query.filter_by(login=login).first()
-    except Exception as e:
-        return server_error(f"Exception occurred during loading user: {str(e)}")
+        metrics = [metric_from_data(None, x) for x in readings]
+    except (TypeError, ValueError, OverflowError, OSError) as e:
+        return bad_request(f"Incorrect metric data: {str(e)}")
 
-    if user and authorize(login, password, user):
-        sensors = Sensor.query.filter_by(token=user.token).all()
-        return create_response_from_data_with_code([x.serial_number for x in sensors], 200)
-    else:
-        return unauthorized(login)
+    # Resolve all sensors of batch at once, only when the whole batch is correct
+    sensor_ids = get_sensor_ids(token, user_id, set(serials))
+    for serial, metric in zip(serials, metrics):
+        metric['sensor'] = sensor_ids[serial]
 
+    logging.info(f"Received {len(metrics)} metrics from {len(sensor_ids)} sensors")
+    store_metrics(metrics)
+
+    return create_response_from_data_with_code({}, 204)
+
+
+@bp.route(SENSORS_API_PREFIX, methods=['GET'])
+@auth_required
+def get_available_sensors(user):
+    sensors = Sensor.query.filter_by(user=user.id).all()
+    return create_response_from_data_with_code([x.serial_number for x in sensors], 200)
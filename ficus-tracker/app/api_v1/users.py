@@ -1,9 +1,11 @@
 from flask import request
-from app import db
+from app import app, db
 from app.api_v1 import bp
+from app.api_v1.auth import auth_required
 from app.api_v1.errors import bad_request, unauthorized, server_error
 from app.models import User
-from app.utils import create_response_from_data_with_code, authorize, parse_authorization_header
+from app.utils import create_response_from_data_with_code, authorize, parse_authorization_header, \
+    generate_access_token
 
 
 USER_API_PREFIX = '/users'
@@ -11,7 +13,11 @@ USER_API_PREFIX = '/users'
 
 @bp.route(f'{USER_API_PREFIX}/authorize', methods=['POST'])
 def create_user_or_return_token():
-    """ Create user and return it's token if user doesn't exists otherwise return user token """
+    """ Create user and return it's token if user doesn't exists otherwise return user token.
+
+    Response also includes signed access token which can be used instead of credentials as
+    'Authorization: Bearer <access_token>' header.
+    """
     resp_data = {}  # response data
     headers = request.headers or {}
 
@@ -36,6 +42,8 @@ def create_user_or_return_token():
         try:
             if authorize(login, password, user):
                 resp_data['token'] = user.token
+                resp_data['access_token'] = generate_access_token(user)
+                resp_data['expires_in'] = app.config['ACCESS_TOKEN_TTL']
                 resp = create_response_from_data_with_code(resp_data, 200)
             else:
                 return unauthorized(login)
@@ -53,43 +61,20 @@ def create_user_or_return_token():
         db.session.add(user)
         db.session.commit()
 
+        resp_data['access_token'] = generate_access_token(user)
+        resp_data['expires_in'] = app.config['ACCESS_TOKEN_TTL']
         resp = create_response_from_data_with_code(resp_data, 200)
 
     return resp
 
 
 @bp.route(USER_API_PREFIX, methods=['GET'])
-def get_user():
+@auth_required
+def get_user(user):
     """ Return user info for authorized user """
-    resp = None
-    resp_data = {}  # response data
-    headers = request.headers or {}
-
-    # Check request
-    if 'Authorization' not in headers:
-        return bad_request("Missing 'Authorization' header in request")
-
-    # Parse auth
     try:
-        login, password = parse_authorization_header(headers.get('Authorization'))
-    except Exception as e:
-        return server_error(f"Exception occurred during parsing user credentials: {str(e)}")
-
-    try:
-        user = User.query.filter_by(login=login).first()
+        user = User.query.get(user.id)
     except Exception as e:
         return server_error(f"Exception occurred during loading user: {str(e)}")
 
-    if not user:
-        resp = create_response_from_data_with_code({}, 200)
-    else:
-        try:
-            auth = authorize(login, password, user)
-        except Exception as e:
-            return server_error(f"Exception occurred authorization: {str(e)}")
-
-        if auth:
-            resp_data = user.to_dict()
-            resp = create_response_from_data_with_code(resp_data, 200)
-
-    return resp
+    return create_response_from_data_with_code(user.to_dict() if user else {}, 200)
@@ -0,0 +1,218 @@
+import datetime
+import logging
+import os
+import shutil
+
+import numpy as np
+from sqlalchemy import func
+
+from app import app, db
+from app.cache import LRUCache
+from app.models import FlowerMetric
+from app.partitions import month_start, next_month
+
+ARCHIVE_METRICS = ['temperature', 'light', 'soilMoisture']
+ARCHIVE_COLUMNS = ['time'] + ARCHIVE_METRICS
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Directory of metrics which sensor was removed and file with time before which all metrics are
+# archived
+UNASSIGNED = 'unassigned'
+HORIZON_FILE = 'archived_until'
+
+# Archive root -> horizon or False, ingest checks every reading against it
+horizon_cache = LRUCache(16, 60.0)
+
+
+class MetricArchive:
+    """ Columnar files of metrics removed from db.
+
+    Every sensor has a directory with a segment for every archived month:
+    <root>/<sensor id>/<YYYY-MM>/{time,temperature,light,soilMoisture}.npy. Times are sorted
+    datetime64[us] and metrics are float32, files are read through memory map without copying.
+    Metrics without sensor are kept in <root>/unassigned.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def segment_path(self, sensor_id, month):
+        return os.path.join(self.root, str(sensor_id) if sensor_id is not None else UNASSIGNED,
+                            f'{month.year}-{month.month:02d}')
+
+    def horizon(self):
+        """ Return time before which all metrics are archived or None """
+        horizon = horizon_cache.get(self.root)
+        if horizon is None:
+            try:
+                with open(os.path.join(self.root, HORIZON_FILE)) as f:
+                    horizon = datetime.datetime.fromisoformat(f.read().strip())
+            except (OSError, ValueError):
+                horizon = False
+            horizon_cache.set(self.root, horizon)
+
+        return horizon or None
+
+    def set_horizon(self, cutoff):
+        """ Move horizon forward to cutoff, metrics before it are not accepted any more """
+        horizon_cache.invalidate(self.root)
+        horizon = self.horizon()
+        if horizon and horizon >= cutoff:
+            return
+
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, HORIZON_FILE)
+        with open(f'{path}.tmp', 'w') as f:
+            f.write(cutoff.isoformat())
+        os.replace(f'{path}.tmp', path)
+        horizon_cache.set(self.root, cutoff)
+
+    def months(self, sensor_id):
+        """ Return sorted starts of archived months of sensor """
+        path = os.path.join(self.root, str(sensor_id))
+        if not os.path.isdir(path):
+            return []
+
+        months = list()
+        for name in os.listdir(path):
+            try:
+                months.append(datetime.datetime.strptime(name, '%Y-%m'))
+            except ValueError:
+                # Segment which is being written
+                continue
+
+        return sorted(months)
+
+    def archived_until(self, sensor_id):
+        """ Return end of the last archived month of sensor or None """
+        months = self.months(sensor_id)
+        return next_month(months[-1]) if months else None
+
+    def load(self, sensor_id, month):
+        """ Return dict column -> memory mapped array of archived month of sensor """
+        path = self.segment_path(sensor_id, month)
+        return {x: np.load(os.path.join(path, f'{x}.npy'), mmap_mode='r') for x in ARCHIVE_COLUMNS}
+
+    def read(self, sensor_id, start=None, end=None):
+        """ Yield dicts column -> array view of archived metrics of sensor by months """
+        for month in self.months(sensor_id):
+            if end is not None and month >= end:
+                break
+            if start is not None and next_month(month) <= start:
+                continue
+
+            columns = self.load(sensor_id, month)
+            times = columns['time']
+            lo = np.searchsorted(times, np.datetime64(start, 'us')) if start is not None else 0
+            hi = np.searchsorted(times, np.datetime64(end, 'us')) if end is not None else \
+                len(times)
+
+            if hi > lo:
+                yield {x: y[lo:hi] for x, y in columns.items()}
+
+    def write(self, sensor_id, month, columns):
+        """ Add metrics of month to segment of sensor, replacing the segment atomically """
+        path = self.segment_path(sensor_id, month)
+
+        if os.path.isdir(path):
+            old = self.load(sensor_id, month)
+            columns = {x: np.concatenate([old[x], columns[x]]) for x in ARCHIVE_COLUMNS}
+
+            # Rows of both segment and db appear if db rows were not removed after archiving
+            order = np.argsort(columns['time'], kind='mergesort')
+            columns = {x: y[order] for x, y in columns.items()}
+            duplicated = np.ones(len(order), dtype=bool)
+            duplicated[0] = False
+            for x in ARCHIVE_COLUMNS:
+                same = columns[x][1:] == columns[x][:-1]
+                if x != 'time':
+                    same |= np.isnan(columns[x][1:]) & np.isnan(columns[x][:-1])
+                duplicated[1:] &= same
+            columns = {x: y[~duplicated] for x, y in columns.items()}
+
+        temp_path = f'{path}.tmp'
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+        for x in ARCHIVE_COLUMNS:
+            np.save(os.path.join(temp_path, f'{x}.npy'), columns[x])
+
+        # Readers keep memory maps of old files after they are removed
+        if os.path.isdir(path):
+            os.rename(path, f'{path}.old')
+        os.rename(temp_path, path)
+        shutil.rmtree(f'{path}.old', ignore_errors=True)
+
+    def history(self, sensor_id, start, end, resolution):
+        """ Return archived metrics of sensor in buckets of resolution seconds as history points """
+        points = list()
+        for columns in self.read(sensor_id, start, end):
+            seconds = columns['time'].astype(np.int64) // 1000000
+            buckets = seconds // resolution * resolution
+            bounds = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+            counts = np.diff(np.r_[bounds, len(buckets)])
+
+            aggregates = dict()
+            for metric in ARCHIVE_METRICS:
+                values = columns[metric].astype(np.float64)
+                aggregates[metric] = (np.add.reduceat(values, bounds),
+                                      np.minimum.reduceat(values, bounds),
+                                      np.maximum.reduceat(values, bounds))
+
+            for i, bucket in enumerate(buckets[bounds].tolist()):
+                point = {'time': EPOCH + datetime.timedelta(seconds=bucket),
+                         'count': int(counts[i])}
+                for metric in ARCHIVE_METRICS:
+                    total, minimum, maximum = (x[i].item() for x in aggregates[metric])
+                    point[metric] = {'avg': total / counts[i].item(), 'min': minimum,
+                                     'max': maximum}
+                points.append(point)
+
+        return points
+
+
+def get_archive():
+    """ Return metric archive or None if archiving is disabled """
+    root = app.config.get('METRIC_ARCHIVE_DIR')
+    return MetricArchive(root) if root else None
+
+
+def archive_metrics(archive, cutoff):
+    """ Copy metrics of months before cutoff month to archive, return number of archived rows.
+
+    Metrics without sensor are archived too, they are removed from db with the rest. Readings
+    before cutoff are rejected by ingest from now on, readers take such months from archive only.
+    """
+    cutoff = month_start(cutoff)
+    month = func.date_trunc('month', FlowerMetric.time)
+
+    archive.set_horizon(cutoff)
+
+    segments = db.session.query(FlowerMetric.sensor, month) \
+        .filter(FlowerMetric.time < cutoff) \
+        .group_by(FlowerMetric.sensor, month) \
+        .order_by(FlowerMetric.sensor, month) \
+        .all()
+
+    archived = 0
+    for sensor_id, start in segments:
+        rows = db.session.query(FlowerMetric.time, FlowerMetric.temperature, FlowerMetric.light,
+                                FlowerMetric.soilMoisture) \
+            .filter(FlowerMetric.sensor == sensor_id if sensor_id is not None else
+                    FlowerMetric.sensor.is_(None),
+                    FlowerMetric.time >= start,
+                    FlowerMetric.time < next_month(start)) \
+            .order_by(FlowerMetric.time) \
+            .all()
+
+        columns = {'time': np.array([x[0] for x in rows], dtype='datetime64[us]')}
+        for i, metric in enumerate(ARCHIVE_METRICS, 1):
+            columns[metric] = np.array([x[i] for x in rows], dtype=np.float32)
+
+        archive.write(sensor_id, start, columns)
+        archived += len(rows)
+
+    if segments:
+        logging.info(f"Archived {archived} metrics of {len(segments)} sensor months")
+
+    return archived
@@ -0,0 +1,154 @@
+import json
+import logging
+import select
+import threading
+import time
+import uuid
+
+from app import db
+
+CHANNEL = 'ficus_tracker'
+
+# Kinds of messages
+MESSAGE_READINGS = 'readings'
+MESSAGE_ALARMS = 'alarms'
+MESSAGE_FLOWERS = 'flowers'
+
+# Postgres rejects notification payloads of 8000 bytes and more
+MAX_PAYLOAD_BYTES = 7900
+
+
+class NotifyBridge:
+    """ Passes changes between processes which share db by LISTEN/NOTIFY.
+
+    Message is a kind and list of items. publish() sends it in the current transaction, so other
+    processes get it only after commit and only if the changes are committed. Handlers of kind
+    are called in listener thread of every other process which listens, messages of own process
+    are skipped. Nothing is sent while bridge isn't enabled, it's used only when several processes
+    serve the same db.
+    """
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex[:8]
+        self.enabled = False
+
+        self._handlers = dict()  # kind -> list of handlers
+        self._keep_listening = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+        # Counters
+        self.sent = 0
+        self.received = 0
+        self.failed = 0
+
+    def subscribe(self, kind, handler):
+        self._handlers.setdefault(kind, list()).append(handler)
+
+    def enable(self):
+        """ Send messages to other processes, this process gets their messages after start() """
+        self.enabled = True
+
+    def start(self, keep_listening=None):
+        """ Listen to messages of other processes.
+
+        Listener stops when keep_listening() returns False, it's checked at least once a minute, and
+        start() is called again when it's needed. Listener runs until process exits by default.
+        """
+        with self._lock:
+            self.enabled = True
+            self._keep_listening = keep_listening
+            if self._thread:
+                return
+
+            self._thread = threading.Thread(target=self._run, args=(), name='notify-bridge')
+            self._thread.daemon = True
+            self._thread.start()
+
+    @property
+    def listening(self):
+        return self._thread is not None
+
+    def publish(self, kind, items):
+        """ Send items to other processes when the current transaction is committed """
+        if not self.enabled or not items:
+            return
+
+        for payload in self._payloads(kind, list(items)):
+            db.session.execute('SELECT pg_notify(:channel, :payload)',
+                               {'channel': CHANNEL, 'payload': payload})
+            self.sent += 1
+
+    def _payloads(self, kind, items):
+        payload = json.dumps({'origin': self.origin, 'kind': kind, 'items': items},
+                             ensure_ascii=False, default=str)
+        if len(payload.encode()) <= MAX_PAYLOAD_BYTES or len(items) == 1:
+            return [payload]
+
+        return self._payloads(kind, items[:len(items) // 2]) + \
+            self._payloads(kind, items[len(items) // 2:])
+
+    def _run(self):
+        while True:
+            try:
+                self._listen()
+            except Exception as e:
+                logging.error(f"Exception occurred in notify bridge, reconnecting: {str(e)}")
+                time.sleep(1)
+
+            with self._lock:
+                if not self._wanted():
+                    self._thread = None
+                    return
+
+    def _wanted(self):
+        return self._keep_listening is None or self._keep_listening()
+
+    def _listen(self):
+        # Connection is taken out of the pool, it listens until listener stops
+        connection = db.engine.raw_connection()
+        connection.detach()
+        try:
+            connection.connection.autocommit = True
+            connection.cursor().execute(f'LISTEN {CHANNEL}')
+            logging.info(f"Notify bridge is listening to channel {CHANNEL}")
+
+            while self._wanted():
+                if select.select([connection.connection], [], [], 60) == ([], [], []):
+                    continue
+
+                connection.connection.poll()
+                while connection.connection.notifies:
+                    self._dispatch(connection.connection.notifies.pop(0).payload)
+
+            logging.info(f"Notify bridge stopped listening to channel {CHANNEL}")
+        finally:
+            connection.close()
+
+    def _dispatch(self, payload):
+        message = json.loads(payload)
+        if message['origin'] == self.origin:
+            return
+
+        self.received += 1
+        for handler in self._handlers.get(message['kind'], ()):
+            try:
+                handler(message['items'])
+            except Exception as e:
+                logging.error(f"Exception occurred while handling {message['kind']} message: "
+                              f"{str(e)}")
+                db.session.rollback()
+                self.failed += 1
+            finally:
+                db.session.remove()
+
+    def stats(self):
+        return {'enabled': self.enabled,
+                'listening': self.listening,
+                'origin': self.origin,
+                'sent': self.sent,
+                'received': self.received,
+                'failed': self.failed}
+
+
+bridge = NotifyBridge()
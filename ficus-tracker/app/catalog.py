@@ -0,0 +1,95 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+
+def _record_type(model):
+    return namedtuple(f'{model.__name__}Record', [x.name for x in model.__table__.columns])
+
+
+def _load_table(model):
+    """ Return read only mapping id -> immutable record for every row of table """
+    record = _record_type(model)
+    rows = model.query.all()
+    return MappingProxyType({x.id: record(*[getattr(x, c) for c in record._fields])
+                             for x in rows}), rows
+
+
+class ReferenceCatalog:
+    """ Immutable in-memory copy of flower types and condition lookup tables.
+
+    These tables are small and change only with new releases, so models and recommendations read
+    them from the catalog instead of querying db. A new catalog is built by reload_catalog().
+    """
+
+    def __init__(self):
+        from app.models import FlowerType, IlluminationType, SoilMoistureType, \
+            AirHumidityType, AlarmSeverity
+
+        self.illuminations, _ = _load_table(IlluminationType)
+        self.soil_moistures, _ = _load_table(SoilMoistureType)
+        self.air_humidities, _ = _load_table(AirHumidityType)
+        self.severities, _ = _load_table(AlarmSeverity)
+        self.flower_types, flower_types = _load_table(FlowerType)
+
+        # Pre-serialized GET /flowers/types response
+        self.flower_types_payload = json.dumps([x.to_dict(self) for x in flower_types],
+                                               ensure_ascii=False, sort_keys=True).encode()
+        self.flower_types_etag = hashlib.sha1(self.flower_types_payload).hexdigest()
+
+        self.loaded_at = time.monotonic()
+
+    def flower_type(self, f_type_id):
+        return self._get('flower_types', f_type_id)
+
+    def illumination(self, illumination_id):
+        return self._get('illuminations', illumination_id)
+
+    def soil_moisture(self, soil_moisture_id):
+        return self._get('soil_moistures', soil_moisture_id)
+
+    def air_humidity(self, air_humidity_id):
+        return self._get('air_humidities', air_humidity_id)
+
+    def severity(self, severity_id):
+        return self._get('severities', severity_id)
+
+    def _get(self, table, key):
+        record = getattr(self, table).get(key)
+
+        # Row may be added after catalog was loaded
+        if record is None and key is not None and \
+                time.monotonic() - self.loaded_at > CATALOG_MIN_RELOAD_INTERVAL:
+            record = getattr(reload_catalog(), table).get(key)
+
+        return record
+
+
+# Minimal number of seconds between reloads caused by unknown ids
+CATALOG_MIN_RELOAD_INTERVAL = 10
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """ Return current reference catalog, loading it on first use """
+    if _catalog is None:
+        return reload_catalog()
+
+    return _catalog
+
+
+def reload_catalog():
+    """ Load reference tables from db and replace current catalog """
+    global _catalog
+    with _catalog_lock:
+        catalog = ReferenceCatalog()
+        _catalog = catalog
+
+    logging.info(f"Reference catalog loaded: {len(catalog.flower_types)} flower types")
+    return catalog
@@ -0,0 +1,250 @@
+import logging
+import os
+import threading
+import time
+
+from app import app, db
+from app.bridge import MESSAGE_READINGS, MESSAGE_ALARMS, MESSAGE_FLOWERS, bridge
+
+
+# Second key of shared advisory lock which every engine process holds, so they can be counted
+MEMBER_LOCK = 2 ** 31 - 1
+
+
+class EngineShards:
+    """ Splits recommendation tasks among processes which serve one db.
+
+    Tasks belong to shard flower id % shards. Every process holds shared advisory lock
+    (lock_key, MEMBER_LOCK) and owns shards by exclusive advisory locks (lock_key, shard). By timer
+    it counts processes and takes free shards or releases the highest ones until it owns
+    ceil(shards / processes), so shards move when a process joins or leaves. Locks of dead
+    process are released with its session. If the process loses its connection, it can't know
+    that nobody else evaluates its shards, so it exits and its server starts a new worker.
+
+    Shard 0 is never released voluntarily, its owner runs tasks which must run once, like metric
+    maintenance.
+    """
+
+    def __init__(self, lock_key, shards, interval):
+        self.lock_key = lock_key
+        self.shards = shards
+        self.interval = interval
+        self.owned = frozenset()
+        self.members = 0
+
+        self._on_acquired = None
+        self._on_released = None
+        self._thread = None
+
+    def start(self, on_acquired, on_released):
+        self._on_acquired = on_acquired
+        self._on_released = on_released
+        self._thread = threading.Thread(target=self._run, args=(), name='engine-shards')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        connection = None
+        while True:
+            try:
+                if connection is None:
+                    connection = db.engine.raw_connection()
+                    connection.detach()
+                    connection.connection.autocommit = True
+                    connection.cursor().execute('SELECT pg_advisory_lock_shared(%s, %s)',
+                                                (self.lock_key, MEMBER_LOCK))
+
+                self._rebalance(connection.cursor())
+            except Exception as e:
+                if self.owned:
+                    logging.critical(f"Connection which holds engine shards is lost, exiting: "
+                                     f"{str(e)}")
+                    os._exit(1)
+
+                logging.error(f"Exception occurred while balancing engine shards: {str(e)}")
+                connection = None
+
+            time.sleep(self.interval)
+
+    def _rebalance(self, cursor):
+        # Advisory locks are server wide, holders in other databases with the same keys are skipped
+        cursor.execute('SELECT count(*) FROM pg_locks WHERE locktype = %s AND classid = %s AND '
+                       'objid = %s AND objsubid = 2 AND granted AND database = '
+                       '(SELECT oid FROM pg_database WHERE datname = current_database())',
+                       ('advisory', self.lock_key, MEMBER_LOCK))
+        self.members = max(cursor.fetchone()[0], 1)
+        target = -(-self.shards // self.members)
+
+        released = sorted(self.owned, reverse=True)[:max(len(self.owned) - target, 0)]
+        for shard in released:
+            cursor.execute('SELECT pg_advisory_unlock(%s, %s)', (self.lock_key, shard))
+        if released:
+            self.owned = self.owned.difference(released)
+            self._changed(self._on_released, released, 'released')
+
+        acquired = list()
+        for shard in range(self.shards):
+            if len(self.owned) + len(acquired) >= target:
+                break
+            if shard in self.owned:
+                continue
+
+            cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', (self.lock_key, shard))
+            if cursor.fetchone()[0]:
+                acquired.append(shard)
+        if acquired:
+            self.owned = self.owned.union(acquired)
+            self._changed(self._on_acquired, acquired, 'acquired')
+
+    def _changed(self, handler, shards, action):
+        logging.info(f"Process {os.getpid()} {action} engine shards {sorted(shards)} of "
+                     f"{self.shards}, {self.members} processes share them")
+        try:
+            handler(frozenset(shards))
+        finally:
+            db.session.remove()
+
+    def owns_flower(self, flower_id):
+        return flower_id % self.shards in self.owned
+
+    def stats(self):
+        return {'lock_key': self.lock_key,
+                'shards': self.shards,
+                'owned': sorted(self.owned),
+                'members': self.members,
+                'pid': os.getpid()}
+
+
+engine_shards = None
+
+# Web workers of multi-process deployment don't run recommendation tasks, engine processes do
+web_worker = False
+
+
+def owns_flower(flower_id):
+    """ Return whether tasks of flower are run by this process """
+    if web_worker:
+        return False
+    return engine_shards is None or engine_shards.owns_flower(flower_id)
+
+
+def flower_shard_filter(column, shards=None):
+    """ Return condition on flower id column which selects flowers of shards, owned shards by
+    default, or None if tasks aren't sharded """
+    if engine_shards is None:
+        return None
+
+    shards = engine_shards.owned if shards is None else shards
+    return (column % engine_shards.shards).in_(sorted(shards))
+
+
+def start_web_worker():
+    """ Make this process a web worker which serves HTTP API and ingest.
+
+    Readings and new flowers are sent to engine processes. Messages of other processes are
+    received only while users of this worker are subscribed to events.
+    """
+    global web_worker
+    web_worker = True
+
+    bridge.subscribe(MESSAGE_READINGS, _on_readings)
+    bridge.subscribe(MESSAGE_ALARMS, _on_alarms)
+    bridge.enable()
+
+
+def listen_for_events():
+    """ Receive changes made by other processes while there are event subscribers, it's called
+    after subscription """
+    from app.events import event_bus
+
+    if web_worker:
+        bridge.start(event_bus.has_subscribers)
+
+
+def start_cluster(start_engine, init_background_tasks):
+    """ Start bridge to other processes and balancing of engine shards in engine process.
+
+    start_engine is called when this process takes shard 0, init_background_tasks is called with
+    every set of taken shards.
+    """
+    global engine_shards
+
+    bridge.subscribe(MESSAGE_READINGS, _on_readings)
+    bridge.subscribe(MESSAGE_ALARMS, _on_alarms)
+    bridge.subscribe(MESSAGE_FLOWERS, _on_flowers)
+    bridge.start()
+
+    def on_acquired(shards):
+        from app.recommendations.alarms import alarm_store
+
+        # Alarms of taken tasks were written by their previous owner
+        alarm_store.load()
+        if 0 in shards:
+            start_engine()
+        init_background_tasks(shards)
+
+    engine_shards = EngineShards(app.config.get('ENGINE_LOCK_KEY', 7303001),
+                                 app.config.get('ENGINE_SHARDS', 1),
+                                 app.config.get('ENGINE_ELECTION_INTERVAL', 5))
+    engine_shards.start(on_acquired, _cancel_shard_tasks)
+
+
+def _cancel_shard_tasks(shards):
+    """ Stop tasks of released shards, a run which is already in progress isn't interrupted """
+    from app.recommendations.engine import scheduler
+
+    for task in scheduler.tasks():
+        flower_id = getattr(getattr(task, 'recom', None), 'flower_id', None)
+        if flower_id is not None and flower_id % engine_shards.shards in shards:
+            task.cancel()
+
+
+def _on_readings(items):
+    """ Handle metrics written by other process: [user id, serial, sensor id, time, temperature,
+    light, soilMoisture] """
+    from app.ingest import parse_reading_time, publish_readings
+    from app.recommendations.engine import scheduler
+    from app.recommendations.recommendations import MetricReading
+    from app.versions import user_versions
+
+    rows = list()
+    for user_id, serial_number, sensor_id, reading_time, temperature, light, soil_moisture \
+            in items:
+        user_versions.register_sensors(user_id, {serial_number: sensor_id})
+        rows.append({'time': parse_reading_time(reading_time), 'sensor': sensor_id,
+                     'temperature': temperature, 'light': light, 'soilMoisture': soil_moisture})
+
+    publish_readings(rows)
+
+    if not web_worker:
+        for row in rows:
+            scheduler.on_reading(MetricReading(**row))
+
+
+def _on_alarms(items):
+    """ Handle alarms changed by other engine process: [flower id, user id, task id, raised, severity,
+    message] """
+    from app.recommendations.alarms import AlarmTransition, publish_transitions
+    from app.recommendations.summary import invalidate_alarm_summaries
+
+    owners = {x[2]: (x[0], x[1]) for x in items}
+    invalidate_alarm_summaries({x[1] for x in items})
+    publish_transitions(owners, [AlarmTransition(x[2], True, x[5], x[4]) for x in items if x[3]],
+                        [x[2] for x in items if not x[3]])
+
+
+def _on_flowers(items):
+    """ Register tasks of flowers created by other process """
+    from app.models import Flower, RecommendationItem
+    from app.recommendations.engine import RecommendationBackGroundTask, scheduler
+    from app.utils import recommendation_classes
+
+    flowers = {x.id: x for x in Flower.query.filter(Flower.id.in_(items)) if owns_flower(x.id)}
+    if not flowers:
+        return
+
+    classes = {x.__name__: x for x in recommendation_classes()}
+    for task in RecommendationItem.query.filter(RecommendationItem.flower.in_(list(flowers))):
+        if task.r_class in classes and not scheduler.is_registered(task.id):
+            RecommendationBackGroundTask(classes[task.r_class].create_from_db(
+                t_id=task.id, flower=flowers[task.flower]))
@@ -0,0 +1,114 @@
+import json
+import threading
+from collections import deque
+
+EVENT_ALARM_RAISED = 'alarm_raised'
+EVENT_ALARM_CLEARED = 'alarm_cleared'
+EVENT_READING = 'reading'
+
+
+class Subscription:
+    """ Bounded queue of events of one subscriber.
+
+    Subscriber which doesn't read events fast enough is dropped when its queue is full, it should
+    reconnect and load current state again.
+    """
+
+    def __init__(self, user_id, event_types, max_events):
+        self.user_id = user_id
+        self.event_types = event_types
+        self.max_events = max_events
+        self.dropped = False
+
+        self._events = deque()
+        self._cond = threading.Condition()
+
+    def put(self, event_type, data):
+        """ Queue event, return False if subscriber is dropped """
+        with self._cond:
+            if self.dropped:
+                return False
+
+            if len(self._events) >= self.max_events:
+                self.dropped = True
+                self._events.clear()
+            else:
+                self._events.append((event_type, data))
+
+            self._cond.notify()
+            return not self.dropped
+
+    def get(self, timeout):
+        """ Return (event type, data) or None if there were no events for timeout seconds """
+        with self._cond:
+            if not self._events and not self.dropped:
+                self._cond.wait(timeout)
+
+            return self._events.popleft() if self._events and not self.dropped else None
+
+
+class EventBus:
+    """ In-process publish/subscribe of user events """
+
+    def __init__(self):
+        self._subscriptions = dict()  # user id -> set of subscriptions
+        self._lock = threading.Lock()
+
+        # Counters
+        self.published = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def subscribe(self, user_id, event_types, max_events=100, max_subscribers=None):
+        """ Return new subscription or None if there are max_subscribers subscriptions already
+        """
+        subscription = Subscription(user_id, frozenset(event_types), max_events)
+        with self._lock:
+            if max_subscribers is not None and \
+                    sum(len(x) for x in self._subscriptions.values()) >= max_subscribers:
+                self.rejected += 1
+                return None
+
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.user_id, None)
+
+    def has_subscribers(self, user_id=None):
+        """ Return whether user, any user by default, has subscribers """
+        return user_id in self._subscriptions if user_id is not None else bool(self._subscriptions)
+
+    def publish(self, user_id, event_type, data):
+        """ Pass event to subscribers of user, dropping slow ones """
+        with self._lock:
+            subscriptions = [x for x in self._subscriptions.get(user_id, ())
+                             if event_type in x.event_types]
+
+        for subscription in subscriptions:
+            if not subscription.put(event_type, data):
+                self.dropped += 1
+                self.unsubscribe(subscription)
+
+        self.published += 1
+
+    def stats(self):
+        with self._lock:
+            return {'users': len(self._subscriptions),
+                    'subscribers': sum(len(x) for x in self._subscriptions.values()),
+                    'published': self.published,
+                    'dropped': self.dropped,
+                    'rejected': self.rejected}
+
+
+def format_event(event_type, data):
+    """ Return event in Server-Sent Events format """
+    return f'event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n'
+
+
+event_bus = EventBus()
@@ -0,0 +1,86 @@
+import csv
+import io
+import json
+
+from app import app, db
+from app.archive import ARCHIVE_COLUMNS, get_archive
+from app.models import FlowerMetric
+
+EXPORT_COLUMNS = ['time', 'id', 'temperature', 'light', 'soilMoisture']
+
+# Export format -> (mimetype, file extension)
+EXPORT_FORMATS = {'ndjson': ('application/x-ndjson', 'ndjson'),
+                  'csv': ('text/csv', 'csv')}
+
+
+def metric_rows(sensor_id, start=None, end=None):
+    """ Yield (time, temperature, light, soilMoisture) of sensor metrics in time order.
+
+    Archived metrics are read first, then metrics which are still in db. Rows are fetched from
+    server side cursor or archive by chunks, so memory doesn't depend on their number.
+    """
+    chunk_rows = app.config.get('EXPORT_CHUNK_ROWS', 1000)
+
+    archive = get_archive()
+    archived_until = archive.archived_until(sensor_id) if archive else None
+    if archived_until:
+        for columns in archive.read(sensor_id, start, end):
+            for i in range(0, len(columns['time']), chunk_rows):
+                yield from zip(*[columns[x][i:i + chunk_rows].tolist() for x in ARCHIVE_COLUMNS])
+
+        start = max(start, archived_until) if start is not None else archived_until
+
+    query = db.session.query(FlowerMetric.time, FlowerMetric.temperature, FlowerMetric.light,
+                             FlowerMetric.soilMoisture) \
+        .filter(FlowerMetric.sensor == sensor_id)
+    if start is not None:
+        query = query.filter(FlowerMetric.time >= start)
+    if end is not None:
+        query = query.filter(FlowerMetric.time < end)
+
+    yield from query.order_by(FlowerMetric.time) \
+        .execution_options(stream_results=True) \
+        .yield_per(chunk_rows)
+
+
+def _chunks(lines):
+    """ Join lines to chunks, so response isn't written by tiny pieces """
+    chunk_rows = app.config.get('EXPORT_CHUNK_ROWS', 1000)
+
+    chunk = list()
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_rows:
+            yield ''.join(chunk)
+            chunk = list()
+
+    if chunk:
+        yield ''.join(chunk)
+
+
+def export_ndjson(rows, serial_number):
+    """ Yield metric rows as JSON objects, one per line """
+    return _chunks(json.dumps({'time': time.isoformat(), 'id': serial_number,
+                               'temperature': temperature, 'light': light,
+                               'soilMoisture': soil_moisture}) + '\n'
+                   for time, temperature, light, soil_moisture in rows)
+
+
+def export_csv(rows, serial_number):
+    """ Yield metric rows as CSV with header """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values):
+        writer.writerow(values)
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value
+
+    def lines():
+        yield line(EXPORT_COLUMNS)
+        for time, temperature, light, soil_moisture in rows:
+            yield line([time.isoformat(), serial_number, temperature, light, soil_moisture])
+
+    return _chunks(lines())
@@ -0,0 +1,432 @@
+import atexit
+import datetime
+import logging
+import threading
+import time
+
+from dateutil import parser as date_parser
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app import app, db
+from app.bridge import MESSAGE_READINGS, bridge
+from app.cache import LRUCache
+from app.events import EVENT_READING, event_bus
+from app.models import FlowerMetric, User, Sensor, SensorLatest
+from app.recommendations.engine import scheduler
+from app.recommendations.recommendations import MetricReading
+from app.rollups import upsert_rollups
+from app.versions import user_versions
+
+METRIC_COLUMNS = ['time', 'sensor', 'temperature', 'light', 'soilMoisture']
+
+# Hub token -> user id, user id -> hub token and (hub token, serial number) -> sensor id
+user_cache = LRUCache(app.config.get('INGEST_CACHE_SIZE', 10000),
+                      app.config.get('INGEST_CACHE_TTL', 300))
+token_cache = LRUCache(app.config.get('INGEST_CACHE_SIZE', 10000),
+                       app.config.get('INGEST_CACHE_TTL', 300))
+sensor_cache = LRUCache(app.config.get('INGEST_CACHE_SIZE', 10000),
+                        app.config.get('INGEST_CACHE_TTL', 300))
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_user_cache(mapper, connection, target):
+    user_cache.clear()
+    token_cache.clear()
+
+
+@event.listens_for(Sensor, 'after_update')
+@event.listens_for(Sensor, 'after_delete')
+def _invalidate_sensor_cache(mapper, connection, target):
+    sensor_cache.clear()
+
+
+def get_user_id(token):
+    """ Return id of user with specified hub token or None """
+    user_id = user_cache.get(token)
+
+    if user_id is None:
+        user = User.query.filter_by(token=token).first()
+        if not user:
+            return None
+
+        user_id = user.id
+        user_cache.set(token, user_id)
+
+    return user_id
+
+
+def get_user_token(user_id):
+    """ Return hub token of user with specified id or None """
+    token = token_cache.get(user_id)
+
+    if token is None:
+        user = User.query.get(user_id)
+        if not user or not user.token:
+            return None
+
+        token = user.token
+        token_cache.set(user_id, token)
+
+    return token
+
+
+def parse_serial(value):
+    """ Return sensor serial number received from hub as int, raise ValueError if it's incorrect """
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"Serial must be an integer, not {value!r}")
+
+    serial = int(value)
+    if not -2 ** 31 <= serial < 2 ** 31:
+        raise ValueError(f"Serial {serial} is out of range")
+
+    return serial
+
+
+def get_sensor_ids(token, user_id, serials):
+    """ Return dict serial number -> sensor id, registering sensors which are not registered.
+
+    Serial numbers must be ints, as returned by parse_serial().
+    """
+    sensor_ids = dict()
+    missing = list()
+
+    for serial in serials:
+        sensor_id = sensor_cache.get((token, serial))
+        if sensor_id is None:
+            missing.append(serial)
+        else:
+            sensor_ids[serial] = sensor_id
+
+    if not missing:
+        user_versions.register_sensors(user_id, sensor_ids)
+        return sensor_ids
+
+    sensors = {x.serial_number: x for x in Sensor.query.filter(
+        Sensor.token == token, Sensor.serial_number.in_(missing)).all()}
+
+    new_sensors = [x for x in missing if x not in sensors]
+    for serial in new_sensors:
+        sensor = Sensor()
+        sensor.serial_number = serial
+        sensor.token = token
+        sensor.user = user_id
+
+        db.session.add(sensor)
+        sensors[serial] = sensor
+
+    if new_sensors:
+        db.session.flush()
+
+    for serial in missing:
+        sensor_ids[serial] = sensors[serial].id
+
+    # Commit changes to db
+    if new_sensors:
+        db.session.commit()
+
+    for serial in missing:
+        sensor_cache.set((token, serial), sensor_ids[serial])
+
+    user_versions.register_sensors(user_id, sensor_ids)
+    return sensor_ids
+
+
+def parse_reading_time(value):
+    """ Convert hub timestamp (unix time or ISO 8601 string) to local naive datetime """
+    if value is None:
+        return datetime.datetime.now()
+
+    if isinstance(value, bool):
+        raise ValueError(f"Time must be unix time or ISO 8601 string, not {value!r}")
+
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value)
+
+    reading_time = date_parser.isoparse(value)
+    if reading_time.tzinfo:
+        reading_time = reading_time.astimezone().replace(tzinfo=None)
+
+    return reading_time
+
+
+def check_reading_time(reading_time):
+    """ Raise ValueError if hub reading is from the future, beyond allowed clock skew, older
+    than retention period or in archived month. Such reading would stop newer readings from
+    updating last metrics, would be removed right away or would never be seen """
+    now = datetime.datetime.now()
+
+    max_skew = app.config.get('INGEST_MAX_CLOCK_SKEW', 300)
+    if reading_time > now + datetime.timedelta(seconds=max_skew):
+        raise ValueError(f"Time {reading_time.isoformat()} is more than {max_skew} seconds ahead")
+
+    days = app.config.get('METRIC_RETENTION_DAYS', 30)
+    if days and reading_time < now - datetime.timedelta(days=days):
+        raise ValueError(f"Time {reading_time.isoformat()} is older than {days} days")
+
+    # Months before archive horizon are read from archive only
+    from app.archive import get_archive
+    archive = get_archive()
+    horizon = archive.horizon() if archive else None
+    if horizon and reading_time < horizon:
+        raise ValueError(f"Time {reading_time.isoformat()} is before {horizon.isoformat()}, "
+                         f"metrics before it are archived")
+
+
+def metric_from_data(sensor_id, data):
+    """ Return FlowerMetric row for raw sensor data received from hub """
+    reading_time = parse_reading_time(data.get('time'))
+    check_reading_time(reading_time)
+
+    return {'time': reading_time,
+            'sensor': sensor_id,
+            'temperature': float(data.get('temperature', -1.0)),
+            'light': 500.0 - float(data.get('light', -1.0)),
+            'soilMoisture': 100.0 - float(data.get('soilMoisture', -1.0)) / 10.0}
+
+
+def insert_metrics(rows):
+    """ Insert metric rows in current transaction with as few statements as possible """
+    connection = db.session.connection()
+
+    if connection.dialect.driver == 'psycopg2':
+        from psycopg2.extras import execute_values
+        columns = ', '.join(f'"{x}"' for x in METRIC_COLUMNS)
+        with connection.connection.cursor() as cursor:
+            execute_values(cursor,
+                           f'INSERT INTO {FlowerMetric.__tablename__} ({columns}) VALUES %s',
+                           [tuple(x[c] for c in METRIC_COLUMNS) for x in rows],
+                           page_size=1000)
+    else:
+        connection.execute(FlowerMetric.__table__.insert(), rows)
+
+
+def latest_metrics(rows):
+    """ Return the newest row of every sensor from metric rows """
+    latest = dict()
+    for row in rows:
+        if row['sensor'] not in latest or latest[row['sensor']]['time'] < row['time']:
+            latest[row['sensor']] = row
+
+    return list(latest.values())
+
+
+def upsert_sensor_latest(rows):
+    """ Update last metrics of sensors in current transaction unless they already are newer.
+
+    Return set of ids of sensors which last metrics are changed.
+    """
+    statement = pg_insert(SensorLatest.__table__).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=[SensorLatest.sensor],
+        set_={x: statement.excluded[x] for x in METRIC_COLUMNS if x != 'sensor'},
+        where=SensorLatest.time < statement.excluded.time) \
+        .returning(SensorLatest.sensor)
+
+    return {x[0] for x in db.session.execute(statement)}
+
+
+def write_metrics(rows):
+    """ Commit metric rows and check recommendations of their sensors """
+    latest = latest_metrics(rows)
+
+    insert_metrics(rows)
+    upsert_rollups(rows)
+
+    # Readings older than stored last metrics are only history, they aren't passed further
+    applied = upsert_sensor_latest(latest)
+    latest = [x for x in latest if x['sensor'] in applied]
+
+    bridge.publish(MESSAGE_READINGS, [
+        [*owner, x['sensor'], x['time'].isoformat(), x['temperature'], x['light'],
+         x['soilMoisture']] for x, owner in
+        ((x, user_versions.sensor_owner(x['sensor'])) for x in latest) if owner])
+    db.session.commit()
+
+    publish_readings(latest)
+
+    # Only the newest reading of every sensor is interesting for recommendations
+    for row in latest:
+        scheduler.on_reading(MetricReading(**row))
+
+
+def publish_readings(rows):
+    """ Pass new last metrics of sensors to event subscribers of their owners """
+    for row in rows:
+        owner = user_versions.sensor_owner(row['sensor'])
+        if owner and event_bus.has_subscribers(owner[0]):
+            event_bus.publish(owner[0], EVENT_READING, {
+                'time': row['time'].isoformat(), 'id': owner[1],
+                'temperature': row['temperature'], 'light': row['light'],
+                'soilMoisture': row['soilMoisture']})
+
+
+def rebuild_sensor_latest():
+    """ Fill last metrics of sensors from metrics history and return number of sensors """
+    columns = ', '.join(f'"{x}"' for x in METRIC_COLUMNS)
+    result = db.session.execute(
+        f'INSERT INTO {SensorLatest.__tablename__} ({columns}) '
+        f'SELECT DISTINCT ON (sensor) {columns} FROM {FlowerMetric.__tablename__} '
+        f'ORDER BY sensor, time DESC '
+        f'ON CONFLICT (sensor) DO UPDATE SET '
+        + ', '.join(f'"{x}" = excluded."{x}"' for x in METRIC_COLUMNS if x != 'sensor') +
+        f' WHERE {SensorLatest.__tablename__}.time < excluded.time')
+    db.session.commit()
+
+    return result.rowcount
+
+
+def store_metrics(rows):
+    """ Write metric rows now or pass them to write-behind buffer if it's enabled """
+    if not rows:
+        return
+
+    if app.config.get('INGEST_WRITE_BEHIND'):
+        get_ingest_buffer().put(rows)
+    else:
+        write_metrics(rows)
+
+
+class IngestBuffer:
+    """ Bounded queue of metric rows which are written by background flusher thread.
+
+    Rows are flushed with one bulk insert when max_rows rows are buffered or when the oldest row
+    waits for max_delay seconds, so at most max_rows rows or max_delay seconds of data can be
+    lost if the process crashes. Producers are blocked while the buffer is full.
+    """
+
+    def __init__(self, max_rows=1000, max_delay=1.0):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+
+        self._rows = list()
+        self._oldest = None  # monotonic time when the oldest buffered row was added
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+
+        # Counters
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.failed_rows = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, args=(), name='ingest-flusher')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """ Stop flusher and write all buffered rows """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def put(self, rows):
+        with self._cond:
+            while len(self._rows) >= self.max_rows and not self._stopped:
+                self._cond.wait()
+
+            if not self._rows:
+                self._oldest = time.monotonic()
+            self._rows.extend(rows)
+
+            if len(self._rows) >= self.max_rows:
+                self._cond.notify_all()
+
+        # Nobody flushes rows after stop
+        if self._stopped:
+            self.flush()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def flush(self):
+        """ Write all buffered rows and return number of written rows """
+        with self._flush_lock:
+            with self._cond:
+                rows, self._rows = self._rows, list()
+                self._oldest = None
+                self._cond.notify_all()
+
+            if not rows:
+                return 0
+
+            started = time.monotonic()
+            try:
+                write_metrics(rows)
+            except Exception as e:
+                logging.error(f"Exception occurred while writing {len(rows)} buffered metrics: "
+                              f"{str(e)}")
+                db.session.rollback()
+                self.failed_rows += len(rows)
+                return 0
+            finally:
+                db.session.remove()
+
+            elapsed = time.monotonic() - started
+            self.flushes += 1
+            self.flushed_rows += len(rows)
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.total_flush_seconds += elapsed
+
+            return len(rows)
+
+    def stats(self):
+        return {'queue_depth': len(self._rows),
+                'max_rows': self.max_rows,
+                'max_delay': self.max_delay,
+                'flushes': self.flushes,
+                'flushed_rows': self.flushed_rows,
+                'failed_rows': self.failed_rows,
+                'last_flush_seconds': self.last_flush_seconds,
+                'max_flush_seconds': self.max_flush_seconds,
+                'avg_flush_seconds': self.total_flush_seconds / self.flushes if self.flushes
+                else 0.0}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if len(self._rows) >= self.max_rows:
+                        break
+
+                    if self._oldest is None:
+                        self._cond.wait()
+                        continue
+
+                    delay = self._oldest + self.max_delay - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+
+                if self._stopped:
+                    return
+
+            self.flush()
+
+
+_ingest_buffer = None
+_ingest_buffer_lock = threading.Lock()
+
+
+def get_ingest_buffer():
+    """ Return write-behind buffer, starting it on first use """
+    global _ingest_buffer
+    with _ingest_buffer_lock:
+        if _ingest_buffer is None:
+            _ingest_buffer = IngestBuffer(app.config.get('INGEST_BUFFER_MAX_ROWS', 1000),
+                                          app.config.get('INGEST_BUFFER_MAX_DELAY', 1.0))
+            _ingest_buffer.start()
+
+        return _ingest_buffer
@@ -0,0 +1,171 @@
+import hashlib
+import hmac
+import logging
+import socketserver
+import struct
+import threading
+import time
+
+from app import app, db
+from app.ingest import get_user_token, get_sensor_ids, metric_from_data, parse_serial, \
+    store_metrics
+
+# Binary reading of hub: user id, tag, serial number, unix time, temperature, light and
+# soilMoisture multiplied by VALUE_SCALE. Values are raw as in JSON readings, they are converted
+# by the same code. Tag is HMAC of the rest of frame with hub token as the key.
+FRAME = struct.Struct('!I8sIIiii')
+TAG = slice(4, 12)
+VALUE_SCALE = 100
+
+
+def frame_tag(token, frame):
+    """ Return tag of frame, it proves that frame was made by hub which knows the token """
+    body = frame[:TAG.start] + frame[TAG.stop:]
+    return hmac.new(str(token).encode(), body, hashlib.sha256).digest()[:8]
+
+
+def encode_frame(user_id, token, serial, timestamp, temperature, light, soil_moisture):
+    """ Return binary reading, hubs send these frames one or several in a datagram.
+    Current time is used if timestamp is not given """
+    frame = FRAME.pack(user_id, bytes(8), serial, int(timestamp or time.time()),
+                       *[int(round(x * VALUE_SCALE)) for x in (temperature, light, soil_moisture)])
+    return frame[:TAG.start] + frame_tag(token, frame) + frame[TAG.stop:]
+
+
+class HubListener:
+    """ Receives binary readings of hubs over UDP and TCP.
+
+    Datagram or TCP stream is a sequence of FRAME frames. Readings go to the same storage as
+    readings received by HTTP API, incorrect frames are dropped and counted, hubs get no replies.
+
+    Frames with wrong tag or with time outside of INGEST_LISTENER_WINDOW seconds from now are
+    rejected, so a captured frame can't be changed and can be replayed only within the window.
+    Frames are not encrypted.
+    """
+
+    def __init__(self):
+        self._servers = list()
+
+        # Counters
+        self.frames = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.failed = 0
+        self.malformed = 0
+        self.invalid = 0
+
+    def start(self, host, udp_port=0, tcp_port=0):
+        listener = self
+
+        class UDPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                listener.handle(self.request[0])
+
+        class TCPHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    data = self.rfile.read(FRAME.size)
+                    if len(data) < FRAME.size:
+                        return
+                    listener.handle(data)
+
+        if udp_port:
+            self._serve(socketserver.UDPServer((host, udp_port), UDPHandler), 'udp')
+        if tcp_port:
+            self._serve(socketserver.ThreadingTCPServer((host, tcp_port), TCPHandler), 'tcp')
+
+    def _serve(self, server, name):
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, args=(),
+                                  name=f'hub-listener-{name}')
+        thread.daemon = True
+        thread.start()
+
+        self._servers.append(server)
+        logging.info(f"Hub listener is receiving {name} readings on {server.server_address}")
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = list()
+
+    def handle(self, data):
+        """ Store readings of frames, return number of stored readings """
+        if not data or len(data) % FRAME.size:
+            self.malformed += 1
+            return 0
+
+        # Frames of one hub are stored together
+        hubs = dict()
+        for offset in range(0, len(data), FRAME.size):
+            frame = data[offset:offset + FRAME.size]
+            hubs.setdefault(FRAME.unpack(frame)[0], list()).append(frame)
+        self.frames += len(data) // FRAME.size
+
+        window = app.config.get('INGEST_LISTENER_WINDOW', 300)
+        now = time.time()
+
+        accepted = rejected = invalid = 0
+        try:
+            for user_id, frames in hubs.items():
+                token = get_user_token(user_id)
+
+                metrics = list()
+                for frame in frames:
+                    _, tag, serial, timestamp, temperature, light, soil_moisture = \
+                        FRAME.unpack(frame)
+                    if not token or not hmac.compare_digest(frame_tag(token, frame), tag) or \
+                            abs(now - timestamp) > window:
+                        rejected += 1
+                        continue
+
+                    # Only incorrect frame is dropped, the rest of hub frames are stored
+                    try:
+                        metrics.append((parse_serial(serial), metric_from_data(None, {
+                            'time': timestamp, 'temperature': temperature / VALUE_SCALE,
+                            'light': light / VALUE_SCALE,
+                            'soilMoisture': soil_moisture / VALUE_SCALE})))
+                    except ValueError as e:
+                        logging.debug(f"Incorrect binary reading of user {user_id}: {str(e)}")
+                        invalid += 1
+
+                if not metrics:
+                    continue
+
+                sensor_ids = get_sensor_ids(token, user_id, {x[0] for x in metrics})
+                for serial, metric in metrics:
+                    metric['sensor'] = sensor_ids[serial]
+                store_metrics([x[1] for x in metrics])
+                accepted += len(metrics)
+        except Exception as e:
+            logging.error(f"Exception occurred while storing binary readings: {str(e)}")
+            db.session.rollback()
+            self.failed += len(data) // FRAME.size - accepted - rejected - invalid
+        finally:
+            db.session.remove()
+
+        self.accepted += accepted
+        self.rejected += rejected
+        self.invalid += invalid
+        return accepted
+
+    def stats(self):
+        return {'frames': self.frames,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'failed': self.failed,
+                'malformed': self.malformed,
+                'invalid': self.invalid}
+
+
+hub_listener = HubListener()
+
+
+def start_hub_listener():
+    """ Start listener if its ports are configured """
+    udp_port = app.config.get('INGEST_LISTENER_UDP_PORT', 0)
+    tcp_port = app.config.get('INGEST_LISTENER_TCP_PORT', 0)
+
+    if udp_port or tcp_port:
+        hub_listener.start(app.config.get('INGEST_LISTENER_HOST', '0.0.0.0'), udp_port, tcp_port)
@@ -1,6 +1,9 @@
 from app import db
-from sqlalchemy import desc
+from sqlalchemy import DDL, event
+from sqlalchemy.ext.declarative import declared_attr
+from app.catalog import get_catalog
 from werkzeug.security import generate_password_hash, check_password_hash
+import datetime
 import uuid
 
 
@@ -9,6 +12,8 @@ class User(db.Model):
     login = db.Column(db.String(64), index=True, unique=True)
     password_hash = db.Column(db.String(128))
     token = db.Column(db.String(128), index=True, unique=True)
+    # Number of changes of alarms and flowers of user, it's a part of ETag of user resources
+    data_version = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
     flowers = db.relationship('Flower', backref='f_user', lazy='dynamic')
     sensors = db.relationship('Sensor', backref='s_user', lazy='dynamic')
 
@@ -60,22 +65,22 @@ class FlowerType(db.Model):
     def light_day_range_to_str(self):
         return f"{self.light_day_min}-{self.light_day_max}"
 
-    def get_illumination_str_by_id(self):
-        illumination = IlluminationType.query.filter_by(id=self.illumination).first()
+    def get_illumination_str_by_id(self, catalog=None):
+        illumination = (catalog or get_catalog()).illumination(self.illumination)
         if illumination:
             return illumination.illumination
         else:
             'None'
 
-    def get_soil_moisture_str_by_id(self):
-        soil_moisture = SoilMoistureType.query.filter_by(id=self.soil_moisture).first()
+    def get_soil_moisture_str_by_id(self, catalog=None):
+        soil_moisture = (catalog or get_catalog()).soil_moisture(self.soil_moisture)
         if soil_moisture:
             return soil_moisture.soil_moisture
         else:
             'None'
 
-    def get_air_humidity_str_by_id(self):
-        air_humidity = AirHumidityType.query.filter_by(id=self.air_humidity).first()
+    def get_air_humidity_str_by_id(self, catalog=None):
+        air_humidity = (catalog or get_catalog()).air_humidity(self.air_humidity)
         if air_humidity:
             return air_humidity.air_humidity
         else:
@@ -97,12 +102,12 @@ class FlowerType(db.Model):
         return {'interval': f'Раз в {self.transplantation_interval*12} месяцев',
                 'month': all_mn[self.transplantation_month]}
 
-    def to_dict(self):
+    def to_dict(self, catalog=None):
         return {'id': self.id, 'name': self.flower_type,
                 'temperature_range': self.temperature_range_to_str(),
-                'illumination': self.get_illumination_str_by_id(),
-                'soil_moisture': self.get_soil_moisture_str_by_id(),
-                'air_humidity': self.get_air_humidity_str_by_id(),
+                'illumination': self.get_illumination_str_by_id(catalog),
+                'soil_moisture': self.get_soil_moisture_str_by_id(catalog),
+                'air_humidity': self.get_air_humidity_str_by_id(catalog),
                 'transplantation': self.get_transplantation_info(),
                 'light_day': self.light_day_range_to_str()}
 
@@ -150,8 +155,7 @@ class Flower(db.Model):
     last_transplantation_year = db.Column(db.Integer)
 
     def get_last_sensor_data(self):
-        metric = FlowerMetric.query.filter_by(sensor=self.sensor).order_by(
-            desc(FlowerMetric.time)).first()
+        metric = SensorLatest.query.get(self.sensor) if self.sensor else None
         if metric:
             return metric.to_dict()
         else:
@@ -161,25 +165,30 @@ class Flower(db.Model):
         if not res:
             res = dict()
 
-        f_type: FlowerType = FlowerType.query.filter_by(id=self.flower_type).first()
+        catalog = get_catalog()
+
+        f_type = catalog.flower_type(self.flower_type)
         res['type'] = f_type.flower_type
         res['t_min'] = f_type.temperature_min
         res['t_max'] = f_type.temperature_max
 
-        il: IlluminationType = IlluminationType.query.filter_by(id=f_type.illumination).first()
+        il = catalog.illumination(f_type.illumination)
 
         res['l_min'] = il.min_value
         res['l_max'] = il.max_value
 
-        sm: SoilMoistureType = SoilMoistureType.query.filter_by(id=f_type.soil_moisture).first()
+        sm = catalog.soil_moisture(f_type.soil_moisture)
 
         res['sm_min'] = sm.min_value
         res['sm_max'] = sm.max_value
 
         return res
 
-    def to_dict(self):
-        res = {'id': self.id, 'name': self.name, 'sensor_data': self.get_last_sensor_data(),
+    def to_dict(self, sensor_data=None):
+        if sensor_data is None:
+            sensor_data = self.get_last_sensor_data()
+
+        res = {'id': self.id, 'name': self.name, 'sensor_data': sensor_data,
                'last_transplantation_year': self.last_transplantation_year}
 
         res = self.get_f_type_data(res)
@@ -208,19 +217,94 @@ class Sensor(db.Model):
 
 
 class FlowerMetric(db.Model):
-    """ Represents metric """
+    """ Represents metric.
+
+    On Postgres the table is partitioned by month of time, see app.partitions. Partition key must
+    be a part of primary key, so it consists of surrogate id and time.
+    """
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
     time = db.Column(db.DateTime, primary_key=True)
-    sensor = db.Column(db.Integer, db.ForeignKey('sensor.id'), index=True)
+    sensor = db.Column(db.Integer, db.ForeignKey('sensor.id'))
     temperature = db.Column(db.Float)
     light = db.Column(db.Float)
     soilMoisture = db.Column(db.Float)
 
-    def to_dict(self):
-        sensor = Sensor.query.filter_by(id=self.sensor).first()
-        return {'time': self.time, 'id': sensor.serial_number, 'temperature': self.temperature,
+    __table_args__ = (db.Index('ix_flower_metric_sensor_time', sensor, time.desc()),
+                      db.Index('ix_flower_metric_time_brin', time, postgresql_using='brin'),
+                      {'postgresql_partition_by': 'RANGE (time)'})
+
+    def to_dict(self, serial_number=None):
+        if serial_number is None:
+            serial_number = Sensor.query.filter_by(id=self.sensor).first().serial_number
+
+        return {'time': self.time, 'id': serial_number, 'temperature': self.temperature,
+                'light': self.light, 'soilMoisture': self.soilMoisture}
+
+
+# Rows out of range of monthly partitions go to default partition
+event.listen(FlowerMetric.__table__, 'after_create', DDL(
+    'CREATE TABLE %(table)s_default PARTITION OF %(table)s DEFAULT').execute_if(dialect='postgresql'))
+
+
+class SensorLatest(db.Model):
+    """ Represents last metric of sensor, it's updated in the same transaction as metric insert """
+    sensor = db.Column(db.Integer, db.ForeignKey('sensor.id'), primary_key=True)
+    time = db.Column(db.DateTime)
+    temperature = db.Column(db.Float)
+    light = db.Column(db.Float)
+    soilMoisture = db.Column(db.Float)
+
+    def to_dict(self, serial_number=None):
+        if serial_number is None:
+            serial_number = Sensor.query.filter_by(id=self.sensor).first().serial_number
+
+        return {'time': self.time, 'id': serial_number, 'temperature': self.temperature,
                 'light': self.light, 'soilMoisture': self.soilMoisture}
 
 
+class MetricRollup:
+    """ Aggregated metrics of sensor for time bucket which starts at time.
+
+    Rows are updated on every metric insert, average of bucket is sum divided by count. Buckets
+    of bucket_seconds, which must divide a day, are counted from midnight.
+    """
+    bucket_seconds = None
+
+    @declared_attr
+    def sensor(cls):
+        return db.Column(db.Integer, db.ForeignKey('sensor.id'), primary_key=True)
+
+    time = db.Column(db.DateTime, primary_key=True)
+    count = db.Column(db.Integer)
+    temperature_sum = db.Column(db.Float)
+    temperature_min = db.Column(db.Float)
+    temperature_max = db.Column(db.Float)
+    light_sum = db.Column(db.Float)
+    light_min = db.Column(db.Float)
+    light_max = db.Column(db.Float)
+    soilMoisture_sum = db.Column(db.Float)
+    soilMoisture_min = db.Column(db.Float)
+    soilMoisture_max = db.Column(db.Float)
+
+    @classmethod
+    def bucket(cls, time):
+        """ Return start of bucket which includes time """
+        midnight = time.replace(hour=0, minute=0, second=0, microsecond=0)
+        seconds = (time - midnight).total_seconds()
+        return midnight + datetime.timedelta(seconds=seconds // cls.bucket_seconds *
+                                             cls.bucket_seconds)
+
+
+class SensorMetricHourly(MetricRollup, db.Model):
+    """ Represents metrics of sensor aggregated by hour """
+    bucket_seconds = 3600
+
+
+class SensorMetricDaily(MetricRollup, db.Model):
+    """ Represents metrics of sensor aggregated by day """
+    bucket_seconds = 86400
+
+
 class RecommendationItem(db.Model):
     """ Represents recommendation model """
     id = db.Column(db.Integer, primary_key=True)
@@ -239,7 +323,7 @@ class RecommendationAlarm(db.Model):
     task = db.Column(db.Integer, db.ForeignKey('recommendation_item.id'))
 
     def get_severity_by_id(self):
-        severity = AlarmSeverity.query.filter_by(id=self.severity).first()
+        severity = get_catalog().severity(self.severity)
         if severity:
             return severity.severity
         else:
@@ -0,0 +1,85 @@
+import datetime
+import logging
+import re
+
+from app import app, db
+from app.models import FlowerMetric
+
+# Monthly partitions are named flower_metric_y2019m04
+PARTITION_NAME_RE = re.compile(rf'^{FlowerMetric.__tablename__}_y(\d{{4}})m(\d{{2}})$')
+
+
+def month_start(value):
+    return datetime.datetime(value.year, value.month, 1)
+
+
+def next_month(value):
+    return datetime.datetime(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'{FlowerMetric.__tablename__}_y{month.year}m{month.month:02d}'
+
+
+def default_partition_name():
+    return f'{FlowerMetric.__tablename__}_default'
+
+
+def metric_partitions():
+    """ Return dict month start -> name of attached monthly partition of metrics table """
+    names = db.session.execute(
+        'SELECT child.relname FROM pg_inherits '
+        'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+        'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+        'WHERE parent.relname = :table', {'table': FlowerMetric.__tablename__}).fetchall()
+
+    partitions = dict()
+    for name, in names:
+        match = PARTITION_NAME_RE.match(name)
+        if match:
+            partitions[datetime.datetime(int(match.group(1)), int(match.group(2)), 1)] = name
+
+    return partitions
+
+
+def create_metric_partition(month):
+    """ Create partition for metrics of month in current transaction.
+
+    Metrics of the month which already are in default partition are moved to the new one, Postgres
+    doesn't attach partition otherwise.
+    """
+    name = partition_name(month)
+    bounds = {'start': month, 'end': next_month(month)}
+
+    db.session.execute(f'CREATE TABLE {name} (LIKE {FlowerMetric.__tablename__} '
+                       f'INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+    db.session.execute(f'WITH moved AS (DELETE FROM {default_partition_name()} '
+                       f'WHERE time >= :start AND time < :end RETURNING *) '
+                       f'INSERT INTO {name} SELECT * FROM moved', bounds)
+    db.session.execute(f"ALTER TABLE {FlowerMetric.__tablename__} ATTACH PARTITION {name} "
+                       f"FOR VALUES FROM ('{bounds['start'].isoformat()}') "
+                       f"TO ('{bounds['end'].isoformat()}')")
+
+    return name
+
+
+def ensure_metric_partitions(months_ahead=None):
+    """ Create partitions from current month up to months_ahead months ahead, return their names """
+    if months_ahead is None:
+        months_ahead = app.config.get('METRIC_PARTITION_MONTHS_AHEAD', 3)
+
+    existing = metric_partitions()
+    created = list()
+
+    month = month_start(datetime.datetime.now())
+    for _ in range(months_ahead + 1):
+        if month not in existing:
+            created.append(create_metric_partition(month))
+        month = next_month(month)
+
+    db.session.commit()
+
+    if created:
+        logging.info(f"Created metric partitions: {', '.join(created)}")
+
+    return created
@@ -0,0 +1,161 @@
+import logging
+import threading
+from collections import namedtuple
+
+# Change of alarm state of recommendation task, message and severity are used for raised alarms
+AlarmTransition = namedtuple('AlarmTransition', ['task', 'raised', 'message', 'severity'])
+
+
+class AlarmStore:
+    """ Keeps ids of tasks which have active alarm.
+
+    State is loaded from db with one query on first use, after that the engine learns whether a
+    task has alarm from memory and db is written only when alarm is raised or cleared. The engine
+    must be the only writer of alarms.
+    """
+
+    def __init__(self):
+        self._active = None  # set of task ids with alarm
+        self._applying = set()  # ids of tasks which transitions are being written
+        self._lock = threading.RLock()
+        self._listeners = list()
+
+        # Counters
+        self.raised = 0
+        self.cleared = 0
+        self.writes = 0
+
+    def load(self):
+        """ Load active alarms from db, replacing current state """
+        with self._lock:
+            self._load()
+        self._notify(None, None)
+
+    def _load(self):
+        from app import db
+        from app.models import RecommendationAlarm
+
+        self._active = {x[0] for x in db.session.query(RecommendationAlarm.task).distinct()}
+        logging.info(f"Alarm state loaded: {len(self._active)} active alarms")
+
+    def add_listener(self, listener):
+        """ Call listener(raised, cleared) with sets of task ids after every change of state.
+        Both are None when the whole state is loaded again. Listeners are called without lock.
+        """
+        self._listeners.append(listener)
+
+    def active_tasks(self):
+        """ Return list of ids of tasks with alarm """
+        with self._lock:
+            if self._active is None:
+                self._load()
+            return list(self._active)
+
+    def is_active(self, t_id):
+        with self._lock:
+            if self._active is None:
+                self._load()
+            return t_id in self._active
+
+    def transition(self, t_id, raised, message=None, severity=None):
+        """ Return transition to required state or None if task already is in it """
+        if self.is_active(t_id) == raised:
+            return None
+        return AlarmTransition(t_id, raised, message, severity)
+
+    def apply(self, transitions):
+        """ Write transitions in one transaction and update state. Return (raised, cleared) """
+        from app import db
+        from app.bridge import MESSAGE_ALARMS, bridge
+        from app.models import RecommendationAlarm
+        from app.recommendations.summary import task_owners, invalidate_alarm_summaries
+        from app.versions import user_versions
+
+        with self._lock:
+            if self._active is None:
+                self._load()
+
+            # Transitions could be made stale by a concurrent check of the same task, tasks which
+            # are being written by another apply are left for the next check
+            to_raise = {x.task: x for x in transitions if x and x.raised and
+                        x.task not in self._active and x.task not in self._applying}
+            to_clear = {x.task for x in transitions if x and not x.raised and
+                        x.task in self._active and x.task not in self._applying}
+            if not to_raise and not to_clear:
+                return 0, 0
+
+            self._applying.update(to_raise)
+            self._applying.update(to_clear)
+
+        # Lock isn't held while db is written, so checks of other tasks aren't blocked
+        try:
+            try:
+                if to_raise:
+                    db.session.execute(RecommendationAlarm.__table__.insert(), [
+                        {'task': x.task, 'message': x.message, 'severity': x.severity}
+                        for x in to_raise.values()])
+
+                if to_clear:
+                    RecommendationAlarm.query \
+                        .filter(RecommendationAlarm.task.in_(list(to_clear))) \
+                        .delete(synchronize_session=False)
+
+                # Other processes learn about changes of alarms after commit
+                owners = task_owners(list(to_raise) + list(to_clear))
+                bridge.publish(MESSAGE_ALARMS, [
+                    [*owners[x.task], x.task, True, x.severity, x.message]
+                    for x in to_raise.values() if x.task in owners] + [
+                    [*owners[x], x, False, None, None] for x in to_clear if x in owners])
+                user_versions.bump(x[1] for x in owners.values())
+
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+            with self._lock:
+                self._active.update(to_raise)
+                self._active.difference_update(to_clear)
+                self.raised += len(to_raise)
+                self.cleared += len(to_clear)
+                self.writes += 1
+        finally:
+            with self._lock:
+                self._applying.difference_update(to_raise)
+                self._applying.difference_update(to_clear)
+
+        invalidate_alarm_summaries({x[1] for x in owners.values()})
+        publish_transitions(owners, list(to_raise.values()), to_clear)
+
+        self._notify(set(to_raise), to_clear)
+        return len(to_raise), len(to_clear)
+
+    def _notify(self, raised, cleared):
+        for listener in self._listeners:
+            listener(raised, cleared)
+
+    def stats(self):
+        return {'active': len(self._active or ()),
+                'raised': self.raised,
+                'cleared': self.cleared,
+                'writes': self.writes}
+
+
+def publish_transitions(owners, raised, cleared):
+    """ Pass changes of alarms to event subscribers of flower owners """
+    from app.events import EVENT_ALARM_RAISED, EVENT_ALARM_CLEARED, event_bus
+
+    for transition in raised:
+        if transition.task in owners:
+            flower_id, user_id = owners[transition.task]
+            event_bus.publish(user_id, EVENT_ALARM_RAISED, {
+                'flower': flower_id, 'task': transition.task, 'severity': transition.severity,
+                'message': transition.message})
+
+    for t_id in cleared:
+        if t_id in owners:
+            flower_id, user_id = owners[t_id]
+            event_bus.publish(user_id, EVENT_ALARM_CLEARED, {'flower': flower_id, 'task': t_id})
+
+
+alarm_store = AlarmStore()
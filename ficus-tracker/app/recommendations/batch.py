@@ -0,0 +1,234 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+from app.recommendations.recommendations import ThresholdProblem, LIMIT_MAX
+
+
+def threshold_classes():
+    from app.utils import recommendation_classes
+    return [x for x in recommendation_classes() if issubclass(x, ThresholdProblem)]
+
+
+class ThresholdBatchEvaluator:
+    """ Checks threshold problems of all flowers in a single pass.
+
+    Last reading of every sensor is loaded with one query, limits of every flower are taken from
+    the reference catalog and checked with NumPy vector comparisons, alarms are then created and
+    removed in one transaction.
+
+    Tasks are added and removed by the scheduler. Their arrays are built again only after such
+    change, alarm flags in them follow transitions of the alarm store.
+    """
+
+    def __init__(self):
+        from app.recommendations.alarms import alarm_store
+
+        self._debouncers = dict()  # t_id -> AlarmDebouncer
+        self._pending = set()  # ids of tasks which debouncers count readings
+        self._tasks = dict()  # t_id -> (recommendation class, flower id)
+        self._items = None  # class name -> (flower ids, task ids, alarm is active) arrays
+        self._positions = None  # t_id -> (class name, index in arrays of class)
+        self._lock = threading.Lock()
+
+        alarm_store.add_listener(self._on_alarms)
+
+    # Columns loaded for every flower, limit names match Flower.get_f_type_data()
+    limit_columns = ['t_min', 't_max', 'l_min', 'l_max', 'sm_min', 'sm_max']
+    columns = limit_columns + ['temperature', 'light', 'soilMoisture']
+
+    @staticmethod
+    def type_limits(catalog):
+        """ Return sorted flower type ids and array of their limits """
+        type_ids = np.array(sorted(catalog.flower_types), dtype=np.int64)
+        limits = list()
+        for type_id in type_ids.tolist():
+            f_type = catalog.flower_type(type_id)
+            il = catalog.illumination(f_type.illumination)
+            sm = catalog.soil_moisture(f_type.soil_moisture)
+            limits.append([f_type.temperature_min, f_type.temperature_max,
+                           il.min_value if il else None, il.max_value if il else None,
+                           sm.min_value if sm else None, sm.max_value if sm else None])
+
+        return type_ids, np.array(limits, dtype=np.float64).reshape(-1, 6)
+
+    def add(self, task):
+        """ Check threshold problem of RecommendationBackGroundTask by following sweeps """
+        with self._lock:
+            self._tasks[task.t_id] = (type(task.recom), task.recom.flower_id)
+            self._items = None
+
+    def remove(self, t_id):
+        with self._lock:
+            if self._tasks.pop(t_id, None) is not None:
+                self._items = None
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def _on_alarms(self, raised, cleared):
+        with self._lock:
+            if self._items is None:
+                return
+            if raised is None:
+                self._items = None
+                return
+
+            for t_ids, active in ((raised, True), (cleared, False)):
+                for t_id in t_ids:
+                    position = self._positions.get(t_id)
+                    if position is not None:
+                        self._items[position[0]][2][position[1]] = active
+
+    def _build_items(self):
+        """ Group tasks by class into arrays, must be called with lock """
+        from app.recommendations.alarms import alarm_store
+
+        groups = dict()
+        for t_id, (r_class, flower_id) in self._tasks.items():
+            group = groups.setdefault(r_class.__name__, ([], []))
+            group[0].append(flower_id)
+            group[1].append(t_id)
+
+        active = np.array(alarm_store.active_tasks(), dtype=np.int64)
+        self._items = dict()
+        self._positions = dict()
+        for name, (flower_ids, task_ids) in groups.items():
+            task_ids = np.array(task_ids, dtype=np.int64)
+            self._items[name] = (np.array(flower_ids, dtype=np.int64), task_ids,
+                                 np.isin(task_ids, active))
+            self._positions.update((t_id, (name, i)) for i, t_id in enumerate(task_ids.tolist()))
+
+        logging.info(f"Threshold sweep arrays built for {len(self._tasks)} tasks")
+
+    def items(self):
+        """ Return arrays of tasks for evaluate(), alarm flags are copied """
+        with self._lock:
+            if self._items is None:
+                self._build_items()
+            return {k: (v[0], v[1], v[2].copy()) for k, v in self._items.items()}
+
+    def load(self):
+        """ Return flower ids, flower names and float array with columns for every flower """
+        from app import db
+        from app.catalog import get_catalog
+        from app.cluster import flower_shard_filter
+        from app.models import Flower, SensorLatest
+
+        query = db.session.query(Flower.id, Flower.name, Flower.flower_type,
+                                 SensorLatest.temperature, SensorLatest.light,
+                                 SensorLatest.soilMoisture) \
+            .join(SensorLatest, SensorLatest.sensor == Flower.sensor)
+
+        # Only flowers of shards of this process are checked if tasks are sharded
+        shard_filter = flower_shard_filter(Flower.id)
+        if shard_filter is not None:
+            query = query.filter(shard_filter)
+
+        rows = query.order_by(Flower.id).all()
+
+        flower_ids = np.array([x[0] for x in rows], dtype=np.int64)
+        names = [x[1] for x in rows]
+        flower_types = np.array([x[2] or 0 for x in rows], dtype=np.int64)
+
+        # Missing values become NaN, so they never violate any limit
+        readings = np.array([x[3:] for x in rows], dtype=np.float64).reshape(-1, 3)
+
+        # Take limits of every flower from limits of its type
+        type_ids, type_limits = self.type_limits(get_catalog())
+        limits = np.full((len(rows), len(self.limit_columns)), np.nan)
+        if len(type_ids):
+            idx = np.minimum(np.searchsorted(type_ids, flower_types), len(type_ids) - 1)
+            known = type_ids[idx] == flower_types
+            limits[known] = type_limits[idx[known]]
+
+        return flower_ids, names, np.hstack([limits, readings])
+
+    def evaluate(self, flower_ids, values, items):
+        """ Return ids of tasks which are violated now.
+
+        items maps recommendation class name to (flower ids, task ids, alarm is active) arrays,
+        limits of tasks with active alarm are moved inside by hysteresis of their class.
+        """
+        raised = list()
+        column = {name: values[:, i] for i, name in enumerate(self.columns)}
+
+        for r_class in threshold_classes():
+            if r_class.__name__ not in items:
+                continue
+
+            # Match tasks to loaded flowers, flowers without readings are not loaded
+            item_flowers, item_tasks, item_active = items[r_class.__name__]
+            idx = np.searchsorted(flower_ids, item_flowers)
+            idx[idx >= len(flower_ids)] = 0
+            found = flower_ids[idx] == item_flowers if len(flower_ids) else \
+                np.zeros(len(item_flowers), dtype=bool)
+
+            value = column[r_class.metric][idx[found]]
+            limit = column[r_class.limit_key][idx[found]]
+            band = r_class.hysteresis * item_active[found]
+
+            if r_class.bound == LIMIT_MAX:
+                violated = value > limit - band
+            else:
+                violated = value < limit + band
+
+            raised.append(item_tasks[found][violated])
+
+        return np.concatenate(raised) if raised else np.array([], dtype=np.int64)
+
+    def sweep(self):
+        """ Check all threshold problems and update their alarms. Return (raised, cleared) """
+        from app.recommendations.alarms import alarm_store
+
+        started = time.monotonic()
+
+        flower_ids, names, values = self.load()
+        name_by_flower = dict(zip(flower_ids.tolist(), names))
+
+        items = self.items()
+        raised = self.evaluate(flower_ids, values, items)
+        alarmed = np.concatenate([x[1][x[2]] for x in items.values()]) if items else \
+            np.array([], dtype=np.int64)
+
+        # Only tasks which contradict their alarm state are passed to debouncers
+        candidates = dict.fromkeys(np.setdiff1d(raised, alarmed).tolist(), True)
+        candidates.update(dict.fromkeys(np.setdiff1d(alarmed, raised).tolist(), False))
+
+        for t_id in self._pending.difference(candidates):
+            if t_id in self._debouncers:
+                self._debouncers[t_id].streak = 0
+        self._pending = set()
+
+        # All transitions of sweep are written in one transaction
+        transitions = list()
+        for t_id, violated in candidates.items():
+            task = self._tasks.get(t_id)
+            if task is None:
+                continue
+
+            r_class, flower = task
+            debouncer = self._debouncers.get(t_id)
+            if debouncer is None:
+                debouncer = self._debouncers[t_id] = r_class.create_debouncer()
+
+            if debouncer.update(not violated, violated) != violated:
+                self._pending.add(t_id)
+            elif violated:
+                transitions.append(alarm_store.transition(
+                    t_id, True, r_class.message.format(name_by_flower[flower]), 0))
+            else:
+                transitions.append(alarm_store.transition(t_id, False))
+
+        for t_id in [x for x in self._debouncers if x not in self._tasks]:
+            del self._debouncers[t_id]
+
+        to_raise, to_clear = alarm_store.apply(transitions)
+
+        logging.info(f"Threshold sweep checked {len(self._tasks)} tasks of {len(flower_ids)} "
+                     f"flowers in {time.monotonic() - started:.3f}s: {to_raise} raised, "
+                     f"{to_clear} cleared")
+
+        return to_raise, to_clear
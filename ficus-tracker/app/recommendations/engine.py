@@ -1,38 +1,295 @@
+import heapq
+import itertools
 import logging
 import time
 import threading
-from app.recommendations.recommendations import DateBasedRecommendation
+from concurrent.futures import ThreadPoolExecutor
 
+from app.recommendations.alarms import alarm_store
+from app.recommendations.recommendations import DateBasedRecommendation, ThresholdProblem
+
+EVALUATION_MODE_POLL = 'poll'
+EVALUATION_MODE_INGEST = 'ingest'
+EVALUATION_MODE_BATCH = 'batch'
+
+
+class RecommendationScheduler:
+    """ Runs registered recommendation tasks on a bounded pool of worker threads.
+
+    Tasks are kept in a priority queue keyed by the time they are due next. A single dispatcher
+    thread hands due tasks to the pool and a task is queued again only after its previous run
+    has finished, so the number of threads and DB sessions does not depend on the number of
+    registered tasks.
+
+    Tasks without interval are checked once after registration and then only when a new reading
+    of their sensor is passed to on_reading().
+    """
+
+    def __init__(self):
+        self.workers = None
+        self._tasks = dict()  # t_id -> RecommendationBackGroundTask
+        self._queue = list()  # heap of (due, entry, t_id)
+        self._sensor_tasks = dict()  # sensor id -> set of ingest driven t_id
+        self._readings = dict()  # sensor id -> last reading waiting for evaluation
+        self._busy_sensors = set()
+        self._entries = itertools.count()
+        self._cond = threading.Condition()
+        self._slots = None
+        self._pool = None
+        self._dispatcher = None
+        self._sweep = None  # ThresholdSweepTask in batch evaluation mode
+
+    def start(self, workers=None):
+        """ Start dispatcher and worker pool if they are not running yet """
+        with self._cond:
+            if self._dispatcher:
+                return
+
+            from app import app
+            if not workers:
+                workers = app.config.get('RECOMMENDATION_WORKERS', 4)
+
+            self.workers = workers
+            self._slots = threading.BoundedSemaphore(workers)
+            self._pool = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='recommendation-worker')
+            self._dispatcher = threading.Thread(target=self._dispatch, args=(),
+                                                name='recommendation-scheduler')
+            self._dispatcher.daemon = True
+            self._dispatcher.start()
+
+            logging.info(f"Recommendation scheduler started with {workers} workers")
+
+            # Tasks learn whether they have alarm from memory after that
+            alarm_store.load()
+
+            if app.config.get('RECOMMENDATION_EVALUATION_MODE') == EVALUATION_MODE_BATCH:
+                self._sweep = ThresholdSweepTask(
+                    app.config.get('RECOMMENDATION_CHECK_INTERVAL', 5))
+                self._tasks[self._sweep.t_id] = self._sweep
+                self._push(self._sweep, 0)
+
+    def register(self, task, delay=0):
+        """ Add task to schedule, replacing previously registered task with the same id """
+        self.start()
+        with self._cond:
+            t_id = task.t_id
+            self._unindex(t_id)
+            self._tasks[t_id] = task
+
+            # Tasks checked by sweep are not queued
+            if self._swept(task):
+                self._sweep.evaluator.add(task)
+                return
+
+            sensor_id = self._reading_sensor(task)
+            if sensor_id is not None:
+                self._sensor_tasks.setdefault(sensor_id, set()).add(t_id)
+
+            self._push(task, delay)
+
+    def cancel(self, t_id):
+        """ Remove task from schedule. A run which is already in progress is not interrupted """
+        with self._cond:
+            self._unindex(t_id)
+            return self._tasks.pop(t_id, None) is not None
+
+    def on_reading(self, reading):
+        """ Check ingest driven tasks of reading sensor against this reading """
+        with self._cond:
+            if reading.sensor not in self._sensor_tasks:
+                return
+
+            # Only the newest reading matters if sensor is already being checked
+            self._readings[reading.sensor] = reading
+            if reading.sensor in self._busy_sensors:
+                return
+            self._busy_sensors.add(reading.sensor)
+
+        self._pool.submit(self._evaluate_sensor, reading.sensor)
+
+    def tasks(self):
+        """ Return list of registered tasks """
+        with self._cond:
+            return list(self._tasks.values())
+
+    def is_registered(self, t_id):
+        return t_id in self._tasks
+
+    def __len__(self):
+        return len(self._tasks)
+
+    @staticmethod
+    def _swept(task):
+        return isinstance(task, RecommendationBackGroundTask) and task.batch
+
+    @classmethod
+    def _reading_sensor(cls, task):
+        """ Return sensor id of task which is checked by readings or None. Other tasks without
+        interval, like maintenance with zero interval, run once """
+        if task.interval or not isinstance(task, RecommendationBackGroundTask) or \
+                cls._swept(task):
+            return None
+        return task.recom.sensor_id
+
+    def _unindex(self, t_id):
+        task = self._tasks.get(t_id)
+        if self._swept(task):
+            self._sweep.evaluator.remove(t_id)
+
+        sensor_id = self._reading_sensor(task) if task is not None else None
+        if sensor_id is not None:
+            sensor_tasks = self._sensor_tasks.get(sensor_id, set())
+            sensor_tasks.discard(t_id)
+            if not sensor_tasks:
+                self._sensor_tasks.pop(sensor_id, None)
+
+    def _push(self, task, delay):
+        task.entry = next(self._entries)
+        heapq.heappush(self._queue, (time.monotonic() + delay, task.entry, task.t_id))
+        self._cond.notify()
+
+    def _next_due_task(self):
+        """ Block until some task is due and return it """
+        with self._cond:
+            while True:
+                if not self._queue:
+                    self._cond.wait()
+                    continue
+
+                due, entry, t_id = self._queue[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                heapq.heappop(self._queue)
+                task = self._tasks.get(t_id)
+
+                # Skip entries of cancelled or re-registered tasks
+                if task and task.entry == entry:
+                    return task
+
+    def _dispatch(self):
+        while True:
+            # Wait for free worker first, so due tasks stay ordered in the queue
+            self._slots.acquire()
+            task = self._next_due_task()
+            self._pool.submit(self._run, task)
+
+    def _run(self, task):
+        from app import db
+        try:
+            task.run()
+        except Exception as e:
+            logging.error(f"Exception occurred while checking task {task.t_id}: {str(e)}")
+            db.session.rollback()
+        finally:
+            db.session.remove()
+            self._slots.release()
+
+            with self._cond:
+                if task.interval and self._tasks.get(task.t_id) is task:
+                    self._push(task, task.interval)
+
+    def _evaluate_sensor(self, sensor_id):
+        from app import db
+        try:
+            while True:
+                with self._cond:
+                    reading = self._readings.pop(sensor_id, None)
+                    if not reading:
+                        self._busy_sensors.discard(sensor_id)
+                        return
+
+                    tasks = [self._tasks[x] for x in self._sensor_tasks.get(sensor_id, ())]
+
+                # Alarms of all tasks of sensor are changed in one transaction
+                transitions = list()
+                for task in tasks:
+                    try:
+                        transitions.append(task.transition(reading))
+                    except Exception as e:
+                        logging.error(f"Exception occurred while checking task {task.t_id}: "
+                                      f"{str(e)}")
+                        db.session.rollback()
+
+                try:
+                    alarm_store.apply(transitions)
+                except Exception as e:
+                    logging.error(f"Exception occurred while writing alarms of sensor "
+                                  f"{sensor_id}: {str(e)}")
+        finally:
+            db.session.remove()
+
+
+scheduler = RecommendationScheduler()
+
+
+class ThresholdSweepTask:
+    """ Checks threshold problems of all flowers at once in batch evaluation mode """
+    t_id = 'threshold-sweep'
+
+    def __init__(self, interval):
+        from app.recommendations.batch import ThresholdBatchEvaluator
 
-class RecommendationBackGroundTask:
-    def __init__(self, recom, interval=5):
         self.interval = interval
+        self.evaluator = ThresholdBatchEvaluator()
+        self.entry = None
+
+    def run(self, reading=None):
+        self.evaluator.sweep()
+
+
+class RecommendationBackGroundTask:
+    def __init__(self, recom, interval=None):
+        from app import app
+
         self.recom = recom
+        self.entry = None
 
-        thread = threading.Thread(target=self.run, args=())
-        thread.daemon = True
-        thread.start()
+        # Threshold problems are checked by ThresholdSweepTask in batch mode
+        self.batch = isinstance(recom, ThresholdProblem) and \
+            app.config.get('RECOMMENDATION_EVALUATION_MODE') == EVALUATION_MODE_BATCH
+        if self.batch:
+            self.interval = None
+            scheduler.register(self)
+            return
 
-    def run(self):
-        from app.models import RecommendationAlarm
-        from app import db
-        while True:
-            alarm = RecommendationAlarm.query.filter_by(task=self.recom.t_id).first()
-
-            if self.recom.check():
-                # logging.info("Creating alarm!")
-                if not alarm:
-                    alarm = RecommendationAlarm()
-                    alarm.task = self.recom.t_id
-                    alarm.message = self.recom.text
-                    alarm.severity = self.recom.severity
-
-                    db.session.add(alarm)
-                    db.session.commit()
+        # Threshold problems can change only with new sensor data, so in ingest mode they are
+        # checked by scheduler.on_reading() instead of the timer
+        if not interval:
+            if isinstance(recom, DateBasedRecommendation):
+                interval = app.config.get('RECOMMENDATION_DATE_CHECK_INTERVAL', 3600)
+            elif isinstance(recom, ThresholdProblem) and \
+                    app.config.get('RECOMMENDATION_EVALUATION_MODE') == EVALUATION_MODE_INGEST:
+                interval = None
             else:
-                if not isinstance(self.recom, DateBasedRecommendation):
-                    if alarm:
-                        db.session.delete(alarm)
-                        db.session.commit()
+                interval = app.config.get('RECOMMENDATION_CHECK_INTERVAL', 5)
+
+        self.interval = interval
+
+        scheduler.register(self)
+
+    @property
+    def t_id(self):
+        return self.recom.t_id
+
+    def cancel(self):
+        return scheduler.cancel(self.recom.t_id)
+
+    def transition(self, reading=None):
+        """ Check recommendation once and return change of its alarm or None """
+        if self.recom.check(reading):
+            return alarm_store.transition(self.recom.t_id, True, self.recom.text,
+                                          self.recom.severity)
+
+        # Alarms of date based recommendations are not cleared by check
+        if not isinstance(self.recom, DateBasedRecommendation):
+            return alarm_store.transition(self.recom.t_id, False)
+
+        return None
 
-            time.sleep(self.interval)
+    def run(self, reading=None):
+        """ Check recommendation once and create or remove its alarm """
+        alarm_store.apply([self.transition(reading)])
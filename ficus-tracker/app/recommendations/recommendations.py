@@ -1,9 +1,16 @@
 import datetime
+import time
 from abc import abstractmethod, ABC
+from collections import namedtuple
 
 import logging
 
-from sqlalchemy import desc
+# Sensor reading passed to recommendations instead of loading it from db
+MetricReading = namedtuple('MetricReading', ['sensor', 'time', 'temperature', 'light',
+                                             'soilMoisture'])
+
+LIMIT_MAX = 'max'
+LIMIT_MIN = 'min'
 
 
 class Recommendation(ABC):
@@ -13,7 +20,7 @@ class Recommendation(ABC):
         self.t_id = t_id
 
     @abstractmethod
-    def check(self):
+    def check(self, last_data=None):
         pass
 
     @staticmethod
@@ -33,7 +40,7 @@ class DateBasedRecommendation(Recommendation, ABC):
             year=self.last_check_date.year + self.interval // 12, month=self.interval % 12 + 1,
             day=15, hour=13)
 
-    def check(self):
+    def check(self, last_data=None):
         # logging.info(f"Checking DateBasedRecommendation for task: {self.t_id}")
         # logging.info(f"Current date: {datetime.datetime.now()}")
         # logging.info(f"Next check date: {self.next_check_date}")
@@ -57,11 +64,11 @@ class TransplantationRecommendation(DateBasedRecommendation):
 
     @staticmethod
     def create_from_db(**kwargs):
-        from app.models import FlowerType
+        from app.catalog import get_catalog
         t_id = kwargs.get('t_id')
         flower = kwargs.get('flower')
-        flower_type = FlowerType.query.filter_by(id=flower.flower_type).first()
-        logging.info(f"Initialize task TransplantationRecommendation for task: {t_id}")
+        flower_type = get_catalog().flower_type(flower.flower_type)
+        logging.debug(f"Initialize task TransplantationRecommendation for task: {t_id}")
         return TransplantationRecommendation(t_id,
                                              flower_type.transplantation_month + 1,
                                              flower_type.transplantation_interval,
@@ -70,227 +77,158 @@ class TransplantationRecommendation(DateBasedRecommendation):
                                              flower.name)
 
 
-class LightMaxProblem(Recommendation):
-    def __init__(self, t_id):
-        self.t_id = t_id
-        from app.models import RecommendationItem, FlowerType, Sensor, Flower, IlluminationType
-        task = RecommendationItem.query.filter_by(id=self.t_id).first()
-        flower = Flower.query.filter_by(id=task.flower).first()
-        self.sensor_id = flower.sensor
-
-        flower_type = FlowerType.query.filter_by(id=flower.flower_type).first()
-        ilum = IlluminationType.query.filter_by(id=flower_type.illumination).first()
-        self.limit = ilum.max_value
-
-        super().__init__(t_id, f"Слишком много света для растения '{flower.name}'", severity=0)
-
-        logging.info(f"Initialized LightMaxProblem for task {self.t_id} and "
-                     f"sensor {self.sensor_id}")
-
-    def check(self):
-        logging.info(f"Checking LightMaxProblem for task: {self.t_id} and "
-                     f"sensor {self.sensor_id}")
-        from app.models import FlowerMetric
-        last_data = FlowerMetric.query.filter_by(
-            sensor=self.sensor_id).order_by(desc(FlowerMetric.time)).first()
-        # logging.info(f"Last data for task LightMaxProblem {self.t_id} and sensor {self.sensor_id} "
-        #              f"is {last_data.to_dict()}")
-
-        if last_data:
-            if float(last_data.light) > float(self.limit):
-                logging.info(f"LightMaxProblem {self.t_id} triggered")
-                return True
-
-        return False
-
-    @staticmethod
-    def create_from_db(**kwargs):
-        return LightMaxProblem(kwargs.get('t_id'))
-
-
-class TemperatureMaxProblem(Recommendation):
-    def __init__(self, t_id):
-        self.t_id = t_id
-        from app.models import RecommendationItem, FlowerType, Flower
-        task = RecommendationItem.query.filter_by(id=self.t_id).first()
-        flower = Flower.query.filter_by(id=task.flower).first()
-        self.sensor_id = flower.sensor
-
-        flower_type = FlowerType.query.filter_by(id=flower.flower_type).first()
-        self.limit = flower_type.temperature_max
-
-        super().__init__(t_id, f"Слишком высокая температура для растения '{flower.name}'", severity=0)
-
-        logging.info(f"Initialized TemperatureMaxProblem for task {self.t_id} and "
-                     f"sensor {self.sensor_id}")
-
-    def check(self):
-        logging.info(f"Checking TemperatureMaxProblem for task: {self.t_id} and "
-                     f"sensor {self.sensor_id}")
-        from app.models import FlowerMetric
-        last_data = FlowerMetric.query.filter_by(
-            sensor=self.sensor_id).order_by(desc(FlowerMetric.time)).first()
-        # logging.info(f"Last data for task LightMaxProblem {self.t_id} and sensor {self.sensor_id} "
-        #              f"is {last_data.to_dict()}")
+class AlarmDebouncer:
+    """ Keeps alarm from flapping when metric is noisy.
 
-        if last_data:
-            if float(last_data.temperature) > float(self.limit):
-                logging.info(f"TemperatureMaxProblem {self.t_id} triggered")
-                return True
+    Alarm state changes only after raise_after consecutive violations or clear_after consecutive
+    normal readings. Alarm is raised again not earlier than hold_seconds after the last change,
+    so number of alarm writes is bounded whatever readings are. Clear isn't held, nothing would
+    check a quiet sensor again when hold is over.
+    """
 
-        return False
+    def __init__(self, raise_after=1, clear_after=1, hold_seconds=0):
+        self.raise_after = raise_after
+        self.clear_after = clear_after
+        self.hold_seconds = hold_seconds
 
-    @staticmethod
-    def create_from_db(**kwargs):
-        return TemperatureMaxProblem(kwargs.get('t_id'))
+        self.streak = 0  # number of consecutive readings which contradict alarm state
+        self.changed_at = None
 
+    def update(self, active, violated):
+        """ Return alarm state after reading """
+        if violated == active:
+            self.streak = 0
+            return active
 
-class TemperatureMinProblem(Recommendation):
-    def __init__(self, t_id):
-        self.t_id = t_id
-        from app.models import RecommendationItem, FlowerType, Flower
-        task = RecommendationItem.query.filter_by(id=self.t_id).first()
-        flower = Flower.query.filter_by(id=task.flower).first()
-        self.sensor_id = flower.sensor
+        self.streak += 1
+        if self.streak < (self.raise_after if violated else self.clear_after):
+            return active
 
-        flower_type = FlowerType.query.filter_by(id=flower.flower_type).first()
-        self.limit = flower_type.temperature_min
+        if violated and self.changed_at is not None and \
+                time.monotonic() - self.changed_at < self.hold_seconds:
+            return active
 
-        super().__init__(t_id, f"Слишком низкая температура для растения '{flower.name}'", severity=0)
+        self.streak = 0
+        self.changed_at = time.monotonic()
+        return violated
 
-        logging.info(f"Initialized TemperatureMinProblem for task {self.t_id} and "
-                     f"sensor {self.sensor_id}")
 
-    def check(self):
-        logging.info(f"Checking TemperatureMinProblem for task: {self.t_id} and "
-                     f"sensor {self.sensor_id}")
-        from app.models import FlowerMetric
-        last_data = FlowerMetric.query.filter_by(
-            sensor=self.sensor_id).order_by(desc(FlowerMetric.time)).first()
-        # logging.info(f"Last data for task LightMaxProblem {self.t_id} and sensor {self.sensor_id} "
-        #              f"is {last_data.to_dict()}")
+class ThresholdProblem(Recommendation, ABC):
+    """ Problem which is raised while last sensor metric is out of flower type limits.
 
-        if last_data:
-            if float(last_data.temperature) < float(self.limit):
-                logging.info(f"TemperatureMinProblem {self.t_id} triggered")
-                return True
+    Raised problem is cleared only when metric is back inside limit by hysteresis, debounce
+    parameters are described in AlarmDebouncer.
+    """
+    metric = None  # FlowerMetric field which is checked
+    limit_key = None  # Flower limit name as in Flower.get_f_type_data()
+    bound = LIMIT_MAX
+    message = None
 
-        return False
+    hysteresis = 0.0
+    raise_after = 1
+    clear_after = 3
+    hold_seconds = 60
 
-    @staticmethod
-    def create_from_db(**kwargs):
-        return TemperatureMinProblem(kwargs.get('t_id'))
+    def __init__(self, t_id, flower=None, limits=None):
+        from app.models import RecommendationItem, Flower
 
+        # Flower and limits of its type are passed when many tasks are created at once
+        if flower is None:
+            task = RecommendationItem.query.filter_by(id=t_id).first()
+            flower = Flower.query.filter_by(id=task.flower).first()
+        if limits is None:
+            limits = flower.get_f_type_data()
 
-class SoilMoistureMaxProblem(Recommendation):
-    def __init__(self, t_id):
-        self.t_id = t_id
-        from app.models import RecommendationItem, FlowerType, Flower, SoilMoistureType
-        task = RecommendationItem.query.filter_by(id=self.t_id).first()
-        flower = Flower.query.filter_by(id=task.flower).first()
+        self.flower_id = flower.id
         self.sensor_id = flower.sensor
+        self.limit = limits[self.limit_key]
+        self.debouncer = self.create_debouncer()
 
-        flower_type = FlowerType.query.filter_by(id=flower.flower_type).first()
-        sm = SoilMoistureType.query.filter_by(id=flower_type.soil_moisture).first()
-        self.limit = sm.max_value
+        super().__init__(t_id, self.message.format(flower.name), severity=0)
 
-        super().__init__(t_id, f"Слишком высокая влажность почвы для растения '{flower.name}'", severity=0)
-
-        logging.info(f"Initialized SoilMoistureMaxProblem for task {self.t_id} and "
+        logging.debug(f"Initialized {type(self).__name__} for task {self.t_id} and "
                      f"sensor {self.sensor_id}")
 
-    def check(self):
-        # logging.info(f"Checking SoilMoistureMaxProblem for task: {self.t_id} and "
-        #              f"sensor {self.sensor_id}")
-        from app.models import FlowerMetric
-        last_data = FlowerMetric.query.filter_by(
-            sensor=self.sensor_id).order_by(desc(FlowerMetric.time)).first()
-        # logging.info(f"Last data for task LightMaxProblem {self.t_id} and sensor {self.sensor_id} "
-        #              f"is {last_data.to_dict()}")
-
-        if last_data:
-            if float(last_data.soilMoisture) > float(self.limit):
-                logging.info(f"SoilMoistureMaxProblem {self.t_id} triggered")
-                return True
+    @classmethod
+    def create_from_db(cls, **kwargs):
+        return cls(kwargs.get('t_id'), kwargs.get('flower'), kwargs.get('limits'))
 
-        return False
+    @classmethod
+    def create_debouncer(cls):
+        return AlarmDebouncer(cls.raise_after, cls.clear_after, cls.hold_seconds)
 
-    @staticmethod
-    def create_from_db(**kwargs):
-        return SoilMoistureMaxProblem(kwargs.get('t_id'))
+    def get_last_data(self):
+        from app.models import SensorLatest
+        return SensorLatest.query.get(self.sensor_id) if self.sensor_id else None
 
+    def check(self, last_data=None):
+        from app.recommendations.alarms import alarm_store
 
-class LightMinProblem(Recommendation):
-    def __init__(self, t_id):
-        self.t_id = t_id
-        from app.models import RecommendationItem, FlowerType, Flower, IlluminationType
-        task = RecommendationItem.query.filter_by(id=self.t_id).first()
-        flower = Flower.query.filter_by(id=task.flower).first()
-        self.sensor_id = flower.sensor
+        if not last_data:
+            last_data = self.get_last_data()
 
-        flower_type = FlowerType.query.filter_by(id=flower.flower_type).first()
-        ilum = IlluminationType.query.filter_by(id=flower_type.illumination).first()
-        self.limit = ilum.min_value
+        active = alarm_store.is_active(self.t_id)
+        if not last_data:
+            return active
 
-        super().__init__(t_id, f"Слишком мало света для растения '{flower.name}'", severity=0)
+        raised = self.debouncer.update(active, self.is_violated(last_data, active))
+        if raised and not active:
+            logging.info(f"{type(self).__name__} {self.t_id} triggered")
 
-        logging.info(f"Initialized LightMinProblem for task {self.t_id} and "
-                     f"sensor {self.sensor_id}")
+        return raised
 
-    def check(self):
-        # logging.info(f"Checking LightMinProblem for task: {self.t_id} and "
-        #              f"sensor {self.sensor_id}")
-        from app.models import FlowerMetric
-        last_data = FlowerMetric.query.filter_by(
-            sensor=self.sensor_id).order_by(desc(FlowerMetric.time)).first()
-        # logging.info(f"Last data for task LightMaxProblem {self.t_id} and sensor {self.sensor_id} "
-        #              f"is {last_data.to_dict()}")
+    def is_violated(self, last_data, active=False):
+        value = float(getattr(last_data, self.metric))
+        limit = float(self.limit)
+        if self.bound == LIMIT_MAX:
+            return value > (limit - self.hysteresis if active else limit)
+        else:
+            return value < (limit + self.hysteresis if active else limit)
 
-        if last_data:
-            if float(last_data.light) < float(self.limit):
-                logging.info(f"LightMinProblem {self.t_id} triggered")
-                return True
 
-        return False
+class LightMaxProblem(ThresholdProblem):
+    metric = 'light'
+    limit_key = 'l_max'
+    bound = LIMIT_MAX
+    message = "Слишком много света для растения '{}'"
+    hysteresis = 10.0
 
-    @staticmethod
-    def create_from_db(**kwargs):
-        return LightMinProblem(kwargs.get('t_id'))
 
+class TemperatureMaxProblem(ThresholdProblem):
+    metric = 'temperature'
+    limit_key = 't_max'
+    bound = LIMIT_MAX
+    message = "Слишком высокая температура для растения '{}'"
+    hysteresis = 0.5
 
-class SoilMoistureMinProblem(Recommendation):
-    def __init__(self, t_id):
-        self.t_id = t_id
-        from app.models import RecommendationItem, FlowerType, Flower, SoilMoistureType
-        task = RecommendationItem.query.filter_by(id=self.t_id).first()
-        flower = Flower.query.filter_by(id=task.flower).first()
-        self.sensor_id = flower.sensor
 
-        flower_type = FlowerType.query.filter_by(id=flower.flower_type).first()
-        sm = SoilMoistureType.query.filter_by(id=flower_type.soil_moisture).first()
-        self.limit = sm.min_value
+class TemperatureMinProblem(ThresholdProblem):
+    metric = 'temperature'
+    limit_key = 't_min'
+    bound = LIMIT_MIN
+    message = "Слишком низкая температура для растения '{}'"
+    hysteresis = 0.5
 
-        super().__init__(t_id, f"Слишком низкая влажность почвы для растения '{flower.name}'", severity=0)
 
-        logging.info(f"Initialized SoilMoistureMinProblem for task {self.t_id} and "
-                     f"sensor {self.sensor_id}")
+class SoilMoistureMaxProblem(ThresholdProblem):
+    metric = 'soilMoisture'
+    limit_key = 'sm_max'
+    bound = LIMIT_MAX
+    message = "Слишком высокая влажность почвы для растения '{}'"
+    hysteresis = 2.0
 
-    def check(self):
-        # logging.info(f"Checking SoilMoistureMinProblem for task: {self.t_id} and "
-        #              f"sensor {self.sensor_id}")
-        from app.models import FlowerMetric
-        last_data = FlowerMetric.query.filter_by(
-            sensor=self.sensor_id).order_by(desc(FlowerMetric.time)).first()
-        # logging.info(f"Last data for task LightMaxProblem {self.t_id} and sensor {self.sensor_id} "
-        #              f"is {last_data.to_dict()}")
 
-        if last_data:
-            if float(last_data.soilMoisture) < float(self.limit):
-                logging.info(f"SoilMoistureMinProblem {self.t_id} triggered")
-                return True
+class LightMinProblem(ThresholdProblem):
+    metric = 'light'
+    limit_key = 'l_min'
+    bound = LIMIT_MIN
+    message = "Слишком мало света для растения '{}'"
+    hysteresis = 10.0
 
-        return False
 
-    @staticmethod
-    def create_from_db(**kwargs):
-        return SoilMoistureMinProblem(kwargs.get('t_id'))
+class SoilMoistureMinProblem(ThresholdProblem):
+    metric = 'soilMoisture'
+    limit_key = 'sm_min'
+    bound = LIMIT_MIN
+    message = "Слишком низкая влажность почвы для растения '{}'"
+    hysteresis = 2.0
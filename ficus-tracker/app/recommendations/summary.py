@@ -0,0 +1,51 @@
+from app import app, db
+from app.cache import LRUCache
+from app.models import Flower, RecommendationAlarm, RecommendationItem
+from app.versions import user_versions
+
+# User id -> (alarm version, dict severity -> tuple of active alarm messages of user flowers)
+summary_cache = LRUCache(app.config.get('ALARM_SUMMARY_CACHE_SIZE', 10000),
+                         app.config.get('ALARM_SUMMARY_CACHE_TTL', 300))
+
+
+def get_alarm_summary(user_id):
+    """ Return active alarm messages of user flowers grouped by severity.
+
+    Summary is cached with alarm version of user which is read before alarms, so cached summary is
+    never older than its version, even if alarms are changed while it's built. It's used only while
+    the version is current, whichever process changed alarms.
+    """
+    version = user_versions.alarm_version(user_id)
+    cached = summary_cache.get(user_id)
+    summary = cached[1] if cached is not None and cached[0] == version else None
+
+    if summary is None:
+        alarms = db.session.query(RecommendationAlarm.severity, RecommendationAlarm.message) \
+            .join(RecommendationItem, RecommendationAlarm.task == RecommendationItem.id) \
+            .join(Flower, Flower.id == RecommendationItem.flower) \
+            .filter(Flower.user == user_id) \
+            .order_by(Flower.id, RecommendationItem.id, RecommendationAlarm.id)
+
+        summary = dict()
+        for severity, message in alarms:
+            summary.setdefault(severity, list()).append(message)
+        summary = {x: tuple(y) for x, y in summary.items()}
+
+        summary_cache.set(user_id, (version, summary))
+
+    return summary
+
+
+def task_owners(task_ids):
+    """ Return dict task id -> (flower id, user id) """
+    owners = db.session.query(RecommendationItem.id, Flower.id, Flower.user) \
+        .join(Flower, Flower.id == RecommendationItem.flower) \
+        .filter(RecommendationItem.id.in_(task_ids))
+
+    return {x[0]: (x[1], x[2]) for x in owners}
+
+
+def invalidate_alarm_summaries(user_ids):
+    """ Drop cached summaries of users, they are rebuilt on next read """
+    for user_id in user_ids:
+        summary_cache.invalidate(user_id)
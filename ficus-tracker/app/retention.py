@@ -0,0 +1,103 @@
+import datetime
+import logging
+import time
+
+from app import app, db
+from app.archive import get_archive, archive_metrics
+from app.models import FlowerMetric
+from app.partitions import metric_partitions, month_start, next_month, ensure_metric_partitions
+
+
+def drop_expired_partitions(cutoff):
+    """ Drop monthly partitions which include only metrics older than cutoff.
+
+    Return number of dropped partitions and estimated number of their rows.
+    """
+    dropped = 0
+    rows = 0
+
+    for month, name in sorted(metric_partitions().items()):
+        if next_month(month) > cutoff:
+            break
+
+        # Statistics estimate is used, counting rows would scan the whole partition
+        rows += max(int(db.session.execute(
+            'SELECT reltuples FROM pg_class WHERE relname = :name', {'name': name}).scalar()), 0)
+
+        # Partition is detached first, so metrics table is locked only for a moment
+        db.session.execute(f'ALTER TABLE {FlowerMetric.__tablename__} DETACH PARTITION {name}')
+        db.session.execute(f'DROP TABLE {name}')
+        db.session.commit()
+
+        logging.info(f"Dropped expired metric partition {name}")
+        dropped += 1
+
+    return dropped, rows
+
+
+def delete_expired_metrics(cutoff, chunk_size):
+    """ Delete metrics older than cutoff by chunks, each in its own transaction. Return count """
+    table = FlowerMetric.__tablename__
+    deleted = 0
+
+    while True:
+        result = db.session.execute(
+            f'DELETE FROM {table} WHERE (id, time) IN '
+            f'(SELECT id, time FROM {table} WHERE time < :cutoff LIMIT :chunk_size)',
+            {'cutoff': cutoff, 'chunk_size': chunk_size})
+        db.session.commit()
+
+        deleted += result.rowcount
+        if result.rowcount < chunk_size:
+            return deleted
+
+
+def apply_metric_retention(days=None, chunk_size=None):
+    """ Remove raw metrics older than retention period, rollups are kept.
+
+    Whole expired partitions are dropped and the rest of expired metrics is deleted by chunks, so
+    neither long locks are held nor large transactions are written. If archive is enabled, only
+    whole months are removed after they are archived. Return statistics of removal.
+    """
+    if days is None:
+        days = app.config.get('METRIC_RETENTION_DAYS', 30)
+    if chunk_size is None:
+        chunk_size = app.config.get('METRIC_RETENTION_CHUNK_SIZE', 10000)
+
+    stats = {'cutoff': None, 'archived_rows': 0, 'dropped_partitions': 0, 'dropped_rows': 0,
+             'deleted_rows': 0, 'seconds': 0.0}
+    if not days:
+        return stats
+
+    started = time.monotonic()
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+
+    archive = get_archive()
+    if archive:
+        cutoff = month_start(cutoff)
+        stats['archived_rows'] = archive_metrics(archive, cutoff)
+
+    stats['cutoff'] = cutoff
+    stats['dropped_partitions'], stats['dropped_rows'] = drop_expired_partitions(cutoff)
+    stats['deleted_rows'] = delete_expired_metrics(cutoff, chunk_size)
+    stats['seconds'] = time.monotonic() - started
+
+    logging.info(f"Metrics older than {cutoff} removed in {stats['seconds']:.3f}s: "
+                 f"{stats['dropped_partitions']} partitions with about {stats['dropped_rows']} "
+                 f"rows dropped, {stats['deleted_rows']} rows deleted, "
+                 f"{stats['archived_rows']} rows archived")
+
+    return stats
+
+
+class MetricMaintenanceTask:
+    """ Creates metric partitions of the next months and removes expired metrics """
+    t_id = 'metric-maintenance'
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.entry = None
+
+    def run(self, reading=None):
+        ensure_metric_partitions()
+        apply_metric_retention()
@@ -0,0 +1,136 @@
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app import db
+from app.archive import get_archive
+from app.models import FlowerMetric, SensorMetricHourly, SensorMetricDaily
+
+ROLLUP_METRICS = ['temperature', 'light', 'soilMoisture']
+
+# Sources of metric history from the finest to the coarsest, raw metrics have no buckets
+HISTORY_SOURCES = [('raw', FlowerMetric, 0),
+                   ('hour', SensorMetricHourly, SensorMetricHourly.bucket_seconds),
+                   ('day', SensorMetricDaily, SensorMetricDaily.bucket_seconds)]
+
+
+def aggregate_metrics(rows, model):
+    """ Return rollup rows of model for metric rows, one row for every sensor and bucket """
+    buckets = dict()
+    for row in rows:
+        key = (row['sensor'], model.bucket(row['time']))
+        bucket = buckets.get(key)
+
+        if bucket is None:
+            bucket = {'sensor': key[0], 'time': key[1], 'count': 0}
+            for metric in ROLLUP_METRICS:
+                bucket[f'{metric}_sum'] = 0.0
+                bucket[f'{metric}_min'] = row[metric]
+                bucket[f'{metric}_max'] = row[metric]
+            buckets[key] = bucket
+
+        bucket['count'] += 1
+        for metric in ROLLUP_METRICS:
+            bucket[f'{metric}_sum'] += row[metric]
+            bucket[f'{metric}_min'] = min(bucket[f'{metric}_min'], row[metric])
+            bucket[f'{metric}_max'] = max(bucket[f'{metric}_max'], row[metric])
+
+    return list(buckets.values())
+
+
+def upsert_rollups(rows):
+    """ Add metric rows to hourly and daily rollups in current transaction """
+    for model in (SensorMetricHourly, SensorMetricDaily):
+        table = model.__table__
+        statement = pg_insert(table).values(aggregate_metrics(rows, model))
+
+        excluded = statement.excluded
+        update = {'count': table.c.count + excluded.count}
+        for metric in ROLLUP_METRICS:
+            update[f'{metric}_sum'] = table.c[f'{metric}_sum'] + excluded[f'{metric}_sum']
+            update[f'{metric}_min'] = func.least(table.c[f'{metric}_min'],
+                                                 excluded[f'{metric}_min'])
+            update[f'{metric}_max'] = func.greatest(table.c[f'{metric}_max'],
+                                                    excluded[f'{metric}_max'])
+
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.sensor, table.c.time], set_=update))
+
+
+def history_source(resolution):
+    """ Return the coarsest source which buckets are not longer than resolution seconds """
+    return [x for x in HISTORY_SOURCES if x[2] <= resolution][-1]
+
+
+def metric_history(sensor_id, start, end, resolution):
+    """ Return source name and metrics of sensor from start to end in buckets of resolution seconds.
+
+    Every point includes start of bucket, number of aggregated metrics and average, minimum and
+    maximum of every metric.
+    """
+    name, model, _ = history_source(resolution)
+    archived = list()
+
+    if model is FlowerMetric:
+        # Metrics removed from db are read from archive
+        archive = get_archive()
+        archived_until = archive.archived_until(sensor_id) if archive else None
+        if archived_until:
+            archived = archive.history(sensor_id, start, min(end, archived_until), resolution)
+            start = max(start, archived_until)
+
+        aggregates = [func.count(FlowerMetric.id)]
+        for metric in ROLLUP_METRICS:
+            column = getattr(FlowerMetric, metric)
+            aggregates.extend([func.sum(column), func.min(column), func.max(column)])
+    else:
+        # Bucket which includes start is returned too
+        start = model.bucket(start)
+        aggregates = [func.sum(model.count)]
+        for metric in ROLLUP_METRICS:
+            aggregates.extend([func.sum(getattr(model, f'{metric}_sum')),
+                               func.min(getattr(model, f'{metric}_min')),
+                               func.max(getattr(model, f'{metric}_max'))])
+
+    # Times are naive, so epoch and back conversion are done in UTC to keep them unchanged
+    epoch = func.floor(func.extract('epoch', model.time) / resolution) * resolution
+    bucket = func.to_timestamp(epoch).op('AT TIME ZONE')('UTC').label('bucket')
+
+    rows = db.session.query(bucket, *aggregates) \
+        .filter(model.sensor == sensor_id, model.time >= start, model.time < end) \
+        .group_by(bucket) \
+        .order_by(bucket) \
+        .all()
+
+    points = list()
+    for row in rows:
+        point = {'time': row[0], 'count': int(row[1])}
+        for i, metric in enumerate(ROLLUP_METRICS):
+            total, minimum, maximum = row[2 + i * 3: 5 + i * 3]
+            point[metric] = {'avg': total / row[1] if total is not None else None,
+                             'min': minimum, 'max': maximum}
+        points.append(point)
+
+    return name, merge_points(archived, points) if archived else points
+
+
+def merge_points(first, second):
+    """ Return history points of both lists, points of the same bucket are combined """
+    merged = dict()
+    for point in first + second:
+        other = merged.get(point['time'])
+        if other is None:
+            merged[point['time']] = point
+            continue
+
+        count = other['count'] + point['count']
+        combined = {'time': point['time'], 'count': count}
+        for metric in ROLLUP_METRICS:
+            parts = [(x[metric], x['count']) for x in (other, point) if x[metric]['avg'] is not None]
+            combined[metric] = {
+                'avg': sum(x['avg'] * n for x, n in parts) / sum(n for _, n in parts)
+                if parts else None,
+                'min': min(x['min'] for x, _ in parts) if parts else None,
+                'max': max(x['max'] for x, _ in parts) if parts else None}
+        merged[point['time']] = combined
+
+    return [merged[x] for x in sorted(merged)]
@@ -1,9 +1,28 @@
 import base64
+import hashlib
+import hmac
 
 from flask import jsonify
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from sqlalchemy import event, inspect
+
+from app import app
+from app.cache import LRUCache
 from app.models import User
 from app.recommendations import recommendations
 
+# Keyed digest of verified credentials -> password hash they were verified against
+credentials_cache = LRUCache(app.config.get('AUTH_CACHE_SIZE', 10000),
+                             app.config.get('AUTH_CACHE_TTL', 60))
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_credentials_cache(mapper, connection, target):
+    if inspect(target).attrs.password_hash.history.has_changes() or \
+            inspect(target).was_deleted:
+        credentials_cache.clear()
+
 
 def create_response_from_data_with_code(data, code: int=200):
     """ Apply method jsonify to specified data and add status_code to result"""
@@ -13,17 +32,49 @@ def create_response_from_data_with_code(data, code: int=200):
     return resp
 
 
+def credentials_digest(login, password):
+    """ Return digest of credentials keyed with application secret """
+    return hmac.new(app.config['SECRET_KEY'], f'{login}:{password}'.encode(),
+                    hashlib.sha256).digest()
+
+
 def authorize(login, password, user=None):
     """ Return true if user credentials correct """
     if not user:
         user = User.query.filter_by(login=login).first()
 
     if user:
-        return user.check_password(password)
+        # Skip slow password hash check for recently verified credentials. Cached entry is valid
+        # only while user has the same password hash
+        key = credentials_digest(login, password)
+        if credentials_cache.get(key) == user.password_hash:
+            return True
+
+        if user.check_password(password):
+            credentials_cache.set(key, user.password_hash)
+            return True
+
+        return False
     else:
         return False
 
 
+access_token_serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='access-token')
+
+
+def generate_access_token(user):
+    """ Return signed access token of user which expires after ACCESS_TOKEN_TTL seconds """
+    return access_token_serializer.dumps({'id': user.id, 'login': user.login})
+
+
+def verify_access_token(token):
+    """ Return user data from access token or None if token is incorrect or expired """
+    try:
+        return access_token_serializer.loads(token, max_age=app.config['ACCESS_TOKEN_TTL'])
+    except BadSignature:
+        return None
+
+
 def parse_authorization_header(auth_header):
     """ Parse auth header and return (login, password) """
     auth_str = auth_header.split(' ')[1]  # Remove 'Basic ' part
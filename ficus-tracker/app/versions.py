@@ -0,0 +1,73 @@
+import hashlib
+import threading
+
+from sqlalchemy import Numeric, func
+
+from app import db
+from app.models import Sensor, SensorLatest, User
+
+
+class VersionRegistry:
+    """ Builds ETags of user resources from data which already exists.
+
+    User row counts changes of alarms and flowers of the user, the counter is increased in the
+    transaction of the change. Readings don't touch it, tag of resources with last metrics
+    includes last reading times of user sensors from sensor_latest instead. Both are read when tag
+    is requested, so every process which serves the db gives the same tag.
+    """
+
+    def __init__(self):
+        self._sensor_owners = dict()  # sensor id -> (user id, serial number)
+        self._lock = threading.Lock()
+
+    def register_sensors(self, user_id, sensor_ids):
+        """ Remember owner of sensors, so their metrics are passed to the owner.
+
+        sensor_ids maps serial number to sensor id.
+        """
+        with self._lock:
+            for serial_number, sensor_id in sensor_ids.items():
+                self._sensor_owners[sensor_id] = (user_id, serial_number)
+
+    def sensor_owner(self, sensor_id):
+        """ Return (user id, serial number) of sensor or None if it's unknown """
+        return self._sensor_owners.get(sensor_id)
+
+    def bump(self, user_ids):
+        """ Increase alarm versions of users in the current transaction """
+        user_ids = sorted(set(user_ids))
+        if not user_ids:
+            return
+
+        # Rows are locked in order of ids, so concurrent changes of several users don't deadlock
+        locked = db.session.query(User.id).filter(User.id.in_(user_ids)) \
+            .order_by(User.id).with_for_update()
+        db.session.execute(User.__table__.update()
+                           .where(User.id.in_(locked.subquery()))
+                           .values(data_version=User.data_version + 1))
+
+    def alarm_version(self, user_id):
+        """ Return number of changes of alarms and flowers of user """
+        return db.session.query(User.data_version).filter(User.id == user_id).scalar() or 0
+
+    def alarm_etag(self, user_id):
+        """ Return tag of resources which include only flowers and alarms of user """
+        return f'{user_id}-{self.alarm_version(user_id)}'
+
+    def etag(self, user_id):
+        """ Return tag of resources which include last metrics of user sensors too.
+
+        Last reading time of a sensor only grows, so their sum changes with every applied reading
+        of any sensor. Maximum would miss a sensor which reports behind the others.
+        """
+        version, readings = db.session.query(
+            User.data_version, func.sum(func.extract('epoch', SensorLatest.time).cast(Numeric))) \
+            .outerjoin(Sensor, Sensor.user == User.id) \
+            .outerjoin(SensorLatest, SensorLatest.sensor == Sensor.id) \
+            .filter(User.id == user_id) \
+            .group_by(User.id).first() or (0, None)
+
+        return f'{user_id}-{version}-{hashlib.sha1(str(readings).encode()).hexdigest()[:12]}'
+
+
+user_versions = VersionRegistry()
@@ -6,9 +6,89 @@ class Config(object):
     # Base parameters
     DATA_DATABASE = 'ficus_tracker'
     JSON_AS_ASCII = False
+    # Must be the same for all processes, random key is generated for each process otherwise
+    SECRET_KEY = os.environ.get('SECRET_KEY', '').encode() or os.urandom(32)
 
     # SQLAlchemy parameters
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') + f'/{DATA_DATABASE}' or \
                               'postgresql:///'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_POOL_SIZE = 20
+    # Pooled connections of one process, it must cover threads which use db at once. Several
+    # processes share max_connections of Postgres, see gunicorn.conf.py
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get('SQLALCHEMY_POOL_SIZE', 20))
+    SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get('SQLALCHEMY_MAX_OVERFLOW', 10))
+
+    # Recommendation engine parameters
+    RECOMMENDATION_WORKERS = int(os.environ.get('RECOMMENDATION_WORKERS', 4))
+    RECOMMENDATION_CHECK_INTERVAL = int(os.environ.get('RECOMMENDATION_CHECK_INTERVAL', 5))
+    RECOMMENDATION_DATE_CHECK_INTERVAL = int(os.environ.get('RECOMMENDATION_DATE_CHECK_INTERVAL',
+                                                            3600))
+    # 'ingest' checks threshold problems when sensor data arrives, 'poll' checks each of them by
+    # timer and 'batch' checks all of them at once by timer
+    RECOMMENDATION_EVALUATION_MODE = os.environ.get('RECOMMENDATION_EVALUATION_MODE', 'ingest')
+
+    # Several processes serving one db split recommendation tasks into ENGINE_SHARDS shards by
+    # flower id, shards are owned by advisory locks with this key and rebalanced every
+    # ENGINE_ELECTION_INTERVAL seconds. One shard makes one process run all tasks
+    ENGINE_LOCK_KEY = int(os.environ.get('ENGINE_LOCK_KEY', 7303001))
+    ENGINE_SHARDS = int(os.environ.get('ENGINE_SHARDS', 1))
+    ENGINE_ELECTION_INTERVAL = float(os.environ.get('ENGINE_ELECTION_INTERVAL', 5))
+    # Pooled connections of engine process of multi-process deployment
+    ENGINE_POOL_SIZE = int(os.environ.get('ENGINE_POOL_SIZE', RECOMMENDATION_WORKERS + 4))
+
+    # Sensor data ingest parameters
+    INGEST_BATCH_MAX_READINGS = int(os.environ.get('INGEST_BATCH_MAX_READINGS', 1000))
+    # Readings more than INGEST_MAX_CLOCK_SKEW seconds ahead of server time are rejected, as well
+    # as readings older than METRIC_RETENTION_DAYS
+    INGEST_MAX_CLOCK_SKEW = int(os.environ.get('INGEST_MAX_CLOCK_SKEW', 300))
+    # Write-behind mode buffers metrics and writes them in batches, up to INGEST_BUFFER_MAX_ROWS
+    # rows or INGEST_BUFFER_MAX_DELAY seconds of data can be lost if the process crashes
+    INGEST_WRITE_BEHIND = os.environ.get('INGEST_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes')
+    INGEST_BUFFER_MAX_ROWS = int(os.environ.get('INGEST_BUFFER_MAX_ROWS', 1000))
+    INGEST_BUFFER_MAX_DELAY = float(os.environ.get('INGEST_BUFFER_MAX_DELAY', 1.0))
+    # Cache of hub token -> user and (token, serial) -> sensor lookups
+    INGEST_CACHE_SIZE = int(os.environ.get('INGEST_CACHE_SIZE', 10000))
+    INGEST_CACHE_TTL = float(os.environ.get('INGEST_CACHE_TTL', 300))
+    # Listener of binary hub readings, zero port disables it
+    INGEST_LISTENER_HOST = os.environ.get('INGEST_LISTENER_HOST', '0.0.0.0')
+    INGEST_LISTENER_UDP_PORT = int(os.environ.get('INGEST_LISTENER_UDP_PORT', 0))
+    INGEST_LISTENER_TCP_PORT = int(os.environ.get('INGEST_LISTENER_TCP_PORT', 0))
+    # Binary readings with time more than INGEST_LISTENER_WINDOW seconds from now are rejected
+    INGEST_LISTENER_WINDOW = int(os.environ.get('INGEST_LISTENER_WINDOW', 300))
+
+    # Metrics are partitioned by month, partitions are created this number of months ahead
+    METRIC_PARTITION_MONTHS_AHEAD = int(os.environ.get('METRIC_PARTITION_MONTHS_AHEAD', 3))
+    # Raw metrics are kept for METRIC_RETENTION_DAYS days (0 keeps them forever), rollups are kept
+    # forever. Expired metrics are removed every METRIC_MAINTENANCE_INTERVAL seconds, 0 removes them
+    # only once after start
+    METRIC_RETENTION_DAYS = int(os.environ.get('METRIC_RETENTION_DAYS', 30))
+    METRIC_RETENTION_CHUNK_SIZE = int(os.environ.get('METRIC_RETENTION_CHUNK_SIZE', 10000))
+    METRIC_MAINTENANCE_INTERVAL = int(os.environ.get('METRIC_MAINTENANCE_INTERVAL', 3600))
+    # Expired metrics are moved to columnar files in this directory instead of being removed,
+    # archiving is disabled if it's empty
+    METRIC_ARCHIVE_DIR = os.environ.get('METRIC_ARCHIVE_DIR', '')
+
+    # Metric history is returned in buckets, so it includes at most HISTORY_MAX_POINTS points. Last
+    # HISTORY_DEFAULT_PERIOD seconds are returned if period isn't specified
+    HISTORY_MAX_POINTS = int(os.environ.get('HISTORY_MAX_POINTS', 500))
+    HISTORY_DEFAULT_PERIOD = int(os.environ.get('HISTORY_DEFAULT_PERIOD', 86400))
+
+    # Metrics export fetches and writes rows by chunks of this size
+    EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', 1000))
+
+    # Cache of active alarm messages of user flowers, it's updated when alarms are changed
+    ALARM_SUMMARY_CACHE_SIZE = int(os.environ.get('ALARM_SUMMARY_CACHE_SIZE', 10000))
+    ALARM_SUMMARY_CACHE_TTL = float(os.environ.get('ALARM_SUMMARY_CACHE_TTL', 300))
+
+    # Server-Sent Events of user flowers, seconds between heartbeats and events queued per client.
+    # Every open stream holds a request thread, more than EVENTS_MAX_STREAMS streams of one process
+    # are rejected
+    EVENTS_HEARTBEAT_INTERVAL = float(os.environ.get('EVENTS_HEARTBEAT_INTERVAL', 15))
+    EVENTS_MAX_QUEUE = int(os.environ.get('EVENTS_MAX_QUEUE', 100))
+    EVENTS_MAX_STREAMS = int(os.environ.get('EVENTS_MAX_STREAMS', 4))
+
+    # Cache of verified user credentials
+    AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', 10000))
+    AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', 60))
+    # Lifetime of signed access tokens in seconds
+    ACCESS_TOKEN_TTL = int(os.environ.get('ACCESS_TOKEN_TTL', 3600))
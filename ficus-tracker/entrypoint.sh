@@ -1,7 +1,35 @@
 #!/usr/bin/env bash
 
-flask db init
-flask db migrate
 flask db upgrade
 
-python /opt/ficus-tracker/ficus_tracker.py
\ No newline at end of file
+# WEB_WORKERS runs several worker processes (0 chooses their number by cores and db connections),
+# otherwise single process development server is used
+if [ -n "$WEB_WORKERS" ]; then
+    # Recommendation engine runs in its own process and is started again if it exits, workers
+    # serve HTTP API and ingest. SIGTERM stops both
+    run_engine() {
+        trap 'kill -TERM $engine 2>/dev/null; wait $engine; exit 0' TERM
+        while true; do
+            flask run-engine &
+            engine=$!
+            wait $engine
+            sleep 1
+        done
+    }
+    run_engine &
+    engine_loop=$!
+
+    gunicorn --config /opt/ficus-tracker/gunicorn.conf.py --chdir /opt/ficus-tracker wsgi:app &
+    web=$!
+
+    trap 'kill -TERM $web 2>/dev/null' TERM INT
+    while kill -0 $web 2>/dev/null; do
+        wait $web
+    done
+
+    kill -TERM $engine_loop
+    wait $engine_loop
+    exit 0
+fi
+
+python /opt/ficus-tracker/ficus_tracker.py
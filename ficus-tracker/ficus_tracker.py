@@ -1,9 +1,13 @@
 from app import app, db
+import click
 import logging
+import signal
+import sys
+import time
 
 logging.basicConfig(format='[%(name)s][%(asctime)s][%(message)s]', level=logging.INFO)
 
-tasks_pool = list()
+tasks_pool = dict()  # task id -> RecommendationBackGroundTask
 
 
 @app.shell_context_processor
@@ -11,30 +15,204 @@ def make_shell_context():
     return {'db': db}
 
 
-def init_background_tasks():
+@app.cli.command('rebuild-sensor-latest')
+def rebuild_sensor_latest_command():
+    """ Fill last metrics of sensors from metrics history """
+    from app.ingest import rebuild_sensor_latest
+    click.echo(f"Updated last metrics of {rebuild_sensor_latest()} sensors")
+
+
+@app.cli.command('create-metric-partitions')
+def create_metric_partitions_command():
+    """ Create monthly partitions of metrics table for the next months """
+    from app.partitions import ensure_metric_partitions
+    created = ensure_metric_partitions()
+    click.echo(f"Created {len(created)} metric partitions")
+
+
+@app.cli.command('apply-metric-retention')
+@click.option('--days', type=int, default=None, help='Days to keep raw metrics')
+@click.option('--chunk-size', type=int, default=None, help='Rows deleted in one transaction')
+def apply_metric_retention_command(days, chunk_size):
+    """ Remove raw metrics older than retention period """
+    from app.retention import apply_metric_retention
+    stats = apply_metric_retention(days, chunk_size)
+    click.echo(f"Archived {stats['archived_rows']} rows, dropped {stats['dropped_partitions']} "
+          f"partitions with about {stats['dropped_rows']} rows, deleted {stats['deleted_rows']} "
+          f"rows in {stats['seconds']:.3f}s")
+
+
+@app.cli.command('benchmark-ingest')
+@click.option('--readings', type=int, default=1000, help='Readings sent by each path')
+@click.option('--sensors', type=int, default=10, help='Sensors which send benchmark readings')
+def benchmark_ingest_command(readings, sensors):
+    """ Compare readings per second of HTTP API and binary listener on one core.
+
+    Readings are handled in this process one by one, without network, and are really stored. They
+    belong to a temporary user, which is removed with its sensors and metrics afterwards.
+    """
+    import uuid
+    from sqlalchemy import func
+    from app.ingest import get_ingest_buffer
+    from app.listener import encode_frame, hub_listener
+    from app.models import FlowerMetric, Sensor, SensorLatest, SensorMetricDaily, \
+        SensorMetricHourly, User
+
+    user = User(login=f'benchmark-{uuid.uuid4().hex[:12]}', token=str(User.generate_token()))
+    db.session.add(user)
+    db.session.commit()
+    user_id, login, token = user.id, user.login, user.token
+
+    # Serial numbers are unique among all users
+    first_serial = (db.session.query(func.max(Sensor.serial_number)).scalar() or 0) + 1
+    db.session.remove()
+
+    client = app.test_client()
+
+    def http_reading(i):
+        client.post(f'/api/v1/hub/{token}/sensor', json={
+            'serial': first_serial + i % sensors, 'temperature': 22.5, 'light': 250,
+            'soilMoisture': 500})
+
+    def binary_reading(i):
+        hub_listener.handle(encode_frame(user_id, token, first_serial + i % sensors, None,
+                                         22.5, 250, 500))
+
+    try:
+        for name, send in (('http', http_reading), ('binary', binary_reading)):
+            # Sensors are registered and caches are filled before measuring
+            for i in range(sensors):
+                send(i)
+
+            wall, cpu = time.perf_counter(), time.process_time()
+            for i in range(readings):
+                send(i)
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+            click.echo(f"{name}: {readings} readings in {wall:.3f}s, {readings / wall:.0f} "
+                       f"readings/s, {readings / cpu:.0f} readings per cpu second")
+    finally:
+        if app.config.get('INGEST_WRITE_BEHIND'):
+            get_ingest_buffer().flush()
+
+        sensor_ids = db.session.query(Sensor.id).filter(Sensor.user == user_id).subquery()
+        for model in (FlowerMetric, SensorLatest, SensorMetricHourly, SensorMetricDaily):
+            model.query.filter(model.sensor.in_(sensor_ids)).delete(synchronize_session=False)
+        Sensor.query.filter(Sensor.user == user_id).delete(synchronize_session=False)
+        User.query.filter(User.id == user_id).delete(synchronize_session=False)
+        db.session.commit()
+
+        click.echo(f"Removed benchmark user {login} and its readings")
+
+
+def init_background_tasks(shards=None):
+    """ Start tasks of flowers of shards, all tasks by default.
+
+    Tasks are loaded with their flowers by one query and tasks of deleted flowers are deleted by
+    one statement, limits of flower types are taken from the reference catalog once per type.
+    """
     from app.utils import recommendation_classes
-    from app import models
+    from app.models import Flower, RecommendationAlarm, RecommendationItem
     from app import RecommendationBackGroundTask
+    from app.cluster import flower_shard_filter
+    from app.recommendations.engine import scheduler
+
+    started = time.monotonic()
+    classes = {x.__name__: x for x in recommendation_classes()}
 
-    registered_tasks = models.RecommendationItem.query.all()
-    for task in registered_tasks:
-        flower = models.Flower.query.filter_by(id=task.flower).first()
-        if not flower:
-            db.session.delete(task)
-            db.session.commit()
-        else:
-            recommendation_class_name = task.r_class
-            recommendation_class = list(filter(lambda x: x.__name__ == recommendation_class_name,
-                                               recommendation_classes()))[0]
+    # Tasks of released shards are cancelled already
+    for t_id in [x for x in tasks_pool if not scheduler.is_registered(x)]:
+        del tasks_pool[t_id]
 
-            logging.info(tasks_pool)
+    def of_shards(query):
+        if shards is None:
+            return query
+        return query.filter(flower_shard_filter(RecommendationItem.flower, shards))
 
-            if not any([x.recom.t_id == task.id for x in tasks_pool]):
-                tasks_pool.append(RecommendationBackGroundTask(
-                    recommendation_class.create_from_db(t_id=task.id, flower=flower)))
+    orphans = of_shards(db.session.query(RecommendationItem.id).filter(
+        ~Flower.query.filter(Flower.id == RecommendationItem.flower).exists()))
+    RecommendationAlarm.query.filter(RecommendationAlarm.task.in_(orphans.subquery())) \
+        .delete(synchronize_session=False)
+    deleted = RecommendationItem.query.filter(RecommendationItem.id.in_(orphans.subquery())) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+    tasks = of_shards(db.session.query(RecommendationItem.id, RecommendationItem.r_class, Flower)
+                      .join(Flower, Flower.id == RecommendationItem.flower)).all()
+
+    limits = dict()  # flower type -> limits of flower type
+    created = 0
+    for t_id, r_class, flower in tasks:
+        if t_id in tasks_pool:
+            continue
+
+        recommendation_class = classes.get(r_class)
+        if not recommendation_class:
+            logging.error(f"Unknown recommendation class {r_class} of task {t_id}")
+            continue
+
+        if flower.flower_type not in limits:
+            limits[flower.flower_type] = flower.get_f_type_data()
+
+        tasks_pool[t_id] = RecommendationBackGroundTask(recommendation_class.create_from_db(
+            t_id=t_id, flower=flower, limits=limits[flower.flower_type]))
+        created += 1
+
+    logging.info(f"Started {created} recommendation tasks in "
+                 f"{time.monotonic() - started:.3f}s, deleted {deleted} tasks of deleted flowers")
+
+
+def start_engine():
+    """ Start metric maintenance and hub listener, they must run in one process """
+    # Metrics of the next months must not go to default partition
+    from app.partitions import ensure_metric_partitions
+    ensure_metric_partitions()
+
+    # Partitions and retention of metrics are maintained in background
+    from app.recommendations.engine import scheduler
+    from app.retention import MetricMaintenanceTask
+    scheduler.register(MetricMaintenanceTask(app.config.get('METRIC_MAINTENANCE_INTERVAL', 3600)))
+
+    # Binary readings of hubs are received besides HTTP API if listener is enabled
+    from app.listener import start_hub_listener
+    start_hub_listener()
+
+
+def init_process():
+    """ Handle signals and load reference data in process which runs the engine """
+    # Exit normally on SIGTERM to flush buffered metrics
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Load reference data, SIGHUP reloads it
+    from app.catalog import reload_catalog
+    reload_catalog()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_catalog())
+
+
+@app.cli.command('run-engine')
+def run_engine_command():
+    """ Run recommendation engine of multi-process deployment, web workers serve HTTP API.
+
+    entrypoint.sh starts one next to web workers and starts it again if it exits, several engine
+    processes split recommendation tasks by shards.
+    """
+    from app.cluster import start_cluster
+
+    # Pool covers engine workers and threads of bridge, shards, hub listener and ingest buffer
+    app.config['SQLALCHEMY_POOL_SIZE'] = app.config.get('ENGINE_POOL_SIZE')
+    app.config['SQLALCHEMY_MAX_OVERFLOW'] = 0
+
+    init_process()
+    start_cluster(start_engine, init_background_tasks)
+
+    while True:
+        time.sleep(3600)
 
 
 if __name__ == '__main__':
+    init_process()
+    start_engine()
+
     # Init tasks
     init_background_tasks()
     app.run(debug=False, host='0.0.0.0', threaded=True)
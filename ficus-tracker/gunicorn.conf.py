@@ -0,0 +1,45 @@
+import multiprocessing
+import os
+
+# Workers must share the key which signs access tokens, a random key is generated in every worker
+# otherwise
+if not os.environ.get('SECRET_KEY'):
+    raise RuntimeError("SECRET_KEY must be set when several worker processes are run")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 16))
+
+# Event streams keep a thread each while they are open, a quarter of threads of every worker can
+# be taken by them
+os.environ.setdefault('EVENTS_MAX_STREAMS', str(max(threads // 4, 1)))
+
+# Pool of every worker covers its request threads, ingest buffer and bridge handlers, bridge
+# listener holds one more connection outside of the pool. Workers read pool parameters from
+# environment after fork
+os.environ.setdefault('SQLALCHEMY_POOL_SIZE', str(threads + 2))
+os.environ.setdefault('SQLALCHEMY_MAX_OVERFLOW', '0')
+db_worker_connections = int(os.environ['SQLALCHEMY_POOL_SIZE']) + \
+    int(os.environ['SQLALCHEMY_MAX_OVERFLOW']) + 1
+
+# Engine process started next to workers holds its pool, bridge and engine shards connections
+db_engine_connections = int(os.environ.get(
+    'ENGINE_POOL_SIZE', int(os.environ.get('RECOMMENDATION_WORKERS', 4)) + 4)) + 2
+
+# Workers are stateless, so their number follows cores, but all of them and the engine must fit
+# into DB_MAX_CONNECTIONS. It must be lower than max_connections of Postgres (100 by default) by
+# connections of other clients
+db_max_connections = int(os.environ.get('DB_MAX_CONNECTIONS', 90))
+workers = int(os.environ.get('WEB_WORKERS', 0)) or \
+    max(min(multiprocessing.cpu_count() * 2 + 1,
+            (db_max_connections - db_engine_connections) // db_worker_connections), 1)
+if workers * db_worker_connections + db_engine_connections > db_max_connections:
+    raise RuntimeError(f"{workers} workers and engine need up to "
+                       f"{workers * db_worker_connections + db_engine_connections} db connections, "
+                       f"DB_MAX_CONNECTIONS is {db_max_connections}. Decrease WEB_WORKERS, "
+                       f"WEB_THREADS or SQLALCHEMY_POOL_SIZE")
+
+# App is imported in every worker after fork, threads of bridge can't survive fork
+preload_app = False
+graceful_timeout = 30
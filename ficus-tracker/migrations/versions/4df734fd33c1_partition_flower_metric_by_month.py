@@ -0,0 +1,104 @@
+"""partition flower metric by month
+
+Revision ID: 4df734fd33c1
+Revises: fc8725b6f153
+Create Date: 2026-10-18 06:53:02.101599
+
+Metrics are moved to table partitioned by month of time with surrogate key, (sensor, time DESC)
+index and BRIN index on time. Partitions are created for every month of existing metrics and for
+the next months, app.partitions creates further ones.
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4df734fd33c1'
+down_revision = 'fc8725b6f153'
+branch_labels = None
+depends_on = None
+
+
+# Number of months after current one which get partitions
+MONTHS_AHEAD = 3
+
+METRIC_COLUMNS = 'time, sensor, temperature, light, "soilMoisture"'
+
+
+def month_start(value):
+    return datetime.datetime(value.year, value.month, 1)
+
+
+def next_month(value):
+    return datetime.datetime(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def upgrade():
+    op.rename_table('flower_metric', 'flower_metric_old')
+    op.execute('ALTER TABLE flower_metric_old RENAME CONSTRAINT flower_metric_pkey '
+               'TO flower_metric_old_pkey')
+    op.drop_index('ix_flower_metric_sensor', table_name='flower_metric_old')
+
+    op.create_table('flower_metric',
+    sa.Column('id', sa.BigInteger(), autoincrement=True, nullable=False),
+    sa.Column('time', sa.DateTime(), nullable=False),
+    sa.Column('sensor', sa.Integer(), nullable=True),
+    sa.Column('temperature', sa.Float(), nullable=True),
+    sa.Column('light', sa.Float(), nullable=True),
+    sa.Column('soilMoisture', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['sensor'], ['sensor.id'], ),
+    sa.PrimaryKeyConstraint('id', 'time'),
+    postgresql_partition_by='RANGE (time)'
+    )
+    op.create_index('ix_flower_metric_sensor_time', 'flower_metric',
+                    ['sensor', sa.text('time DESC')], unique=False)
+    op.create_index('ix_flower_metric_time_brin', 'flower_metric', ['time'], unique=False,
+                    postgresql_using='brin')
+    op.execute('CREATE TABLE flower_metric_default PARTITION OF flower_metric DEFAULT')
+
+    # Partitions for every month since the oldest metric
+    first = op.get_bind().execute('SELECT min(time) FROM flower_metric_old').scalar()
+    month = month_start(first or datetime.datetime.now())
+    last = month_start(datetime.datetime.now())
+    for _ in range(MONTHS_AHEAD):
+        last = next_month(last)
+
+    while month <= last:
+        end = next_month(month)
+        op.execute(f"CREATE TABLE flower_metric_y{month.year}m{month.month:02d} "
+                   f"PARTITION OF flower_metric "
+                   f"FOR VALUES FROM ('{month.isoformat()}') TO ('{end.isoformat()}')")
+
+        # Metrics are copied month by month in time order, so BRIN ranges stay narrow
+        op.execute(f"INSERT INTO flower_metric ({METRIC_COLUMNS}) "
+                   f"SELECT {METRIC_COLUMNS} FROM flower_metric_old "
+                   f"WHERE time >= '{month.isoformat()}' AND time < '{end.isoformat()}' "
+                   f"ORDER BY time")
+        month = end
+
+    op.drop_table('flower_metric_old')
+
+
+def downgrade():
+    op.create_table('flower_metric_old',
+    sa.Column('time', sa.DateTime(), nullable=False),
+    sa.Column('sensor', sa.Integer(), nullable=True),
+    sa.Column('temperature', sa.Float(), nullable=True),
+    sa.Column('light', sa.Float(), nullable=True),
+    sa.Column('soilMoisture', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['sensor'], ['sensor.id'], ),
+    sa.PrimaryKeyConstraint('time', name='flower_metric_old_pkey')
+    )
+
+    # Time is the only key of old table, metrics of the same time are dropped except one
+    op.execute(f'INSERT INTO flower_metric_old ({METRIC_COLUMNS}) '
+               f'SELECT DISTINCT ON (time) {METRIC_COLUMNS} FROM flower_metric ORDER BY time, id')
+
+    # Partitions are dropped with partitioned table
+    op.drop_table('flower_metric')
+    op.rename_table('flower_metric_old', 'flower_metric')
+    op.execute('ALTER TABLE flower_metric RENAME CONSTRAINT flower_metric_old_pkey '
+               'TO flower_metric_pkey')
+    op.create_index('ix_flower_metric_sensor', 'flower_metric', ['sensor'], unique=False)
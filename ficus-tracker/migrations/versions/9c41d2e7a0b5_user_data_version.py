@@ -0,0 +1,26 @@
+"""user data version
+
+Revision ID: 9c41d2e7a0b5
+Revises: bee48bc2ffb1
+Create Date: 2026-10-18 14:12:31.418207
+
+Version counts changes of alarms and flowers of user, it is a part of ETag of user resources.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c41d2e7a0b5'
+down_revision = 'bee48bc2ffb1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('data_version', sa.BigInteger(), server_default='0',
+                                    nullable=False))
+
+
+def downgrade():
+    op.drop_column('user', 'data_version')
@@ -0,0 +1,48 @@
+"""hourly and daily metric rollups
+
+Revision ID: bee48bc2ffb1
+Revises: 4df734fd33c1
+Create Date: 2026-10-18 06:54:45.002782
+
+Rollups are filled from existing metrics.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'bee48bc2ffb1'
+down_revision = '4df734fd33c1'
+branch_labels = None
+depends_on = None
+
+
+METRICS = ['temperature', 'light', 'soilMoisture']
+
+ROLLUPS = {'sensor_metric_hourly': 'hour', 'sensor_metric_daily': 'day'}
+
+
+def upgrade():
+    for table, precision in ROLLUPS.items():
+        columns = [sa.Column('sensor', sa.Integer(), nullable=False),
+                   sa.Column('time', sa.DateTime(), nullable=False),
+                   sa.Column('count', sa.Integer(), nullable=True)]
+        for metric in METRICS:
+            columns.extend([sa.Column(f'{metric}_sum', sa.Float(), nullable=True),
+                            sa.Column(f'{metric}_min', sa.Float(), nullable=True),
+                            sa.Column(f'{metric}_max', sa.Float(), nullable=True)])
+
+        op.create_table(table, *columns,
+                        sa.ForeignKeyConstraint(['sensor'], ['sensor.id'], ),
+                        sa.PrimaryKeyConstraint('sensor', 'time'))
+
+        aggregates = ', '.join(f'sum("{x}"), min("{x}"), max("{x}")' for x in METRICS)
+        op.execute(f"INSERT INTO {table} "
+                   f"SELECT sensor, date_trunc('{precision}', time), count(*), {aggregates} "
+                   f"FROM flower_metric WHERE sensor IS NOT NULL "
+                   f"GROUP BY sensor, date_trunc('{precision}', time)")
+
+
+def downgrade():
+    for table in ROLLUPS:
+        op.drop_table(table)
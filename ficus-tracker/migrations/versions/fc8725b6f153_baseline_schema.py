@@ -0,0 +1,188 @@
+"""baseline schema
+
+Revision ID: fc8725b6f153
+Revises: 
+Create Date: 2026-10-18 06:52:18.317114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'fc8725b6f153'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases deployed before migrations were added to repository already have some tables
+    existing = set(sa.inspect(op.get_bind()).get_table_names())
+
+    if 'air_humidity_type' not in existing:
+        op.create_table('air_humidity_type',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('air_humidity', sa.String(length=64), nullable=True),
+        sa.Column('min_value', sa.Float(), nullable=True),
+        sa.Column('max_value', sa.Float(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('air_humidity')
+        )
+
+    if 'alarm_severity' not in existing:
+        op.create_table('alarm_severity',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('severity', sa.String(length=64), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('severity')
+        )
+
+    if 'illumination_type' not in existing:
+        op.create_table('illumination_type',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('illumination', sa.String(length=64), nullable=True),
+        sa.Column('min_value', sa.Float(), nullable=True),
+        sa.Column('max_value', sa.Float(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('illumination')
+        )
+
+    if 'soil_moisture_type' not in existing:
+        op.create_table('soil_moisture_type',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('soil_moisture', sa.String(length=64), nullable=True),
+        sa.Column('min_value', sa.Float(), nullable=True),
+        sa.Column('max_value', sa.Float(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('soil_moisture')
+        )
+
+    if 'user' not in existing:
+        op.create_table('user',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('login', sa.String(length=64), nullable=True),
+        sa.Column('password_hash', sa.String(length=128), nullable=True),
+        sa.Column('token', sa.String(length=128), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index(op.f('ix_user_login'), 'user', ['login'], unique=True)
+        op.create_index(op.f('ix_user_token'), 'user', ['token'], unique=True)
+
+    if 'flower_type' not in existing:
+        op.create_table('flower_type',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('flower_type', sa.String(length=128), nullable=True),
+        sa.Column('temperature_min', sa.Integer(), nullable=True),
+        sa.Column('temperature_max', sa.Integer(), nullable=True),
+        sa.Column('illumination', sa.Integer(), nullable=True),
+        sa.Column('soil_moisture', sa.Integer(), nullable=True),
+        sa.Column('air_humidity', sa.Integer(), nullable=True),
+        sa.Column('light_day_min', sa.Integer(), nullable=True),
+        sa.Column('light_day_max', sa.Integer(), nullable=True),
+        sa.Column('transplantation_month', sa.Integer(), nullable=True),
+        sa.Column('transplantation_interval', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['air_humidity'], ['air_humidity_type.id'], ),
+        sa.ForeignKeyConstraint(['illumination'], ['illumination_type.id'], ),
+        sa.ForeignKeyConstraint(['soil_moisture'], ['soil_moisture_type.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index(op.f('ix_flower_type_flower_type'), 'flower_type', ['flower_type'], unique=True)
+
+    if 'sensor' not in existing:
+        op.create_table('sensor',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('serial_number', sa.Integer(), nullable=True),
+        sa.Column('user', sa.Integer(), nullable=True),
+        sa.Column('token', sa.String(length=128), nullable=True),
+        sa.ForeignKeyConstraint(['user'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index(op.f('ix_sensor_serial_number'), 'sensor', ['serial_number'], unique=True)
+
+    if 'flower' not in existing:
+        op.create_table('flower',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=128), nullable=True),
+        sa.Column('flower_type', sa.Integer(), nullable=True),
+        sa.Column('user', sa.Integer(), nullable=True),
+        sa.Column('sensor', sa.Integer(), nullable=True),
+        sa.Column('last_transplantation_year', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['flower_type'], ['flower_type.id'], ),
+        sa.ForeignKeyConstraint(['sensor'], ['sensor.id'], ),
+        sa.ForeignKeyConstraint(['user'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index(op.f('ix_flower_name'), 'flower', ['name'], unique=True)
+
+    if 'flower_metric' not in existing:
+        op.create_table('flower_metric',
+        sa.Column('time', sa.DateTime(), nullable=False),
+        sa.Column('sensor', sa.Integer(), nullable=True),
+        sa.Column('temperature', sa.Float(), nullable=True),
+        sa.Column('light', sa.Float(), nullable=True),
+        sa.Column('soilMoisture', sa.Float(), nullable=True),
+        sa.ForeignKeyConstraint(['sensor'], ['sensor.id'], ),
+        sa.PrimaryKeyConstraint('time')
+        )
+        op.create_index(op.f('ix_flower_metric_sensor'), 'flower_metric', ['sensor'], unique=False)
+
+    if 'sensor_latest' not in existing:
+        op.create_table('sensor_latest',
+        sa.Column('sensor', sa.Integer(), nullable=False),
+        sa.Column('time', sa.DateTime(), nullable=True),
+        sa.Column('temperature', sa.Float(), nullable=True),
+        sa.Column('light', sa.Float(), nullable=True),
+        sa.Column('soilMoisture', sa.Float(), nullable=True),
+        sa.ForeignKeyConstraint(['sensor'], ['sensor.id'], ),
+        sa.PrimaryKeyConstraint('sensor')
+        )
+
+    if 'recommendation_item' not in existing:
+        op.create_table('recommendation_item',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('r_class', sa.String(length=128), nullable=True),
+        sa.Column('flower', sa.Integer(), nullable=True),
+        sa.Column('raised', sa.Boolean(), nullable=True),
+        sa.ForeignKeyConstraint(['flower'], ['flower.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+
+    if 'recommendation_alarm' not in existing:
+        op.create_table('recommendation_alarm',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('severity', sa.Integer(), nullable=True),
+        sa.Column('message', sa.String(length=300), nullable=True),
+        sa.Column('task', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['severity'], ['alarm_severity.id'], ),
+        sa.ForeignKeyConstraint(['task'], ['recommendation_item.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+
+    if 'sensor_latest' not in existing and 'flower_metric' in existing:
+        op.execute('INSERT INTO sensor_latest (sensor, time, temperature, light, "soilMoisture") '
+                   'SELECT DISTINCT ON (sensor) sensor, time, temperature, light, "soilMoisture" '
+                   'FROM flower_metric WHERE sensor IS NOT NULL ORDER BY sensor, time DESC')
+
+
+def downgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.drop_table('recommendation_alarm')
+    op.drop_table('recommendation_item')
+    op.drop_table('sensor_latest')
+    op.drop_index(op.f('ix_flower_metric_sensor'), table_name='flower_metric')
+    op.drop_table('flower_metric')
+    op.drop_index(op.f('ix_flower_name'), table_name='flower')
+    op.drop_table('flower')
+    op.drop_index(op.f('ix_sensor_serial_number'), table_name='sensor')
+    op.drop_table('sensor')
+    op.drop_index(op.f('ix_flower_type_flower_type'), table_name='flower_type')
+    op.drop_table('flower_type')
+    op.drop_index(op.f('ix_user_token'), table_name='user')
+    op.drop_index(op.f('ix_user_login'), table_name='user')
+    op.drop_table('user')
+    op.drop_table('soil_moisture_type')
+    op.drop_table('illumination_type')
+    op.drop_table('alarm_severity')
+    op.drop_table('air_humidity_type')
+    # ### end Alembic commands ###
@@ -0,0 +1,15 @@
+""" Entry point of WSGI server which runs several worker processes.
+
+Workers serve HTTP API and ingest, recommendation tasks are run by engine processes started by
+'flask run-engine'. Processes learn about changes of each other by LISTEN/NOTIFY.
+"""
+import os
+
+# Access tokens and cached credentials are signed by the key, all workers must share it
+if not os.environ.get('SECRET_KEY'):
+    raise RuntimeError("SECRET_KEY must be set when several worker processes are run")
+
+from app.cluster import start_web_worker
+from ficus_tracker import app
+
+start_web_worker()